@@ -1,13 +1,41 @@
-from flask import Flask, render_template, request, jsonify, abort
-import sqlite3
+from flask import Flask, render_template, request, jsonify, abort, Response, make_response, g, has_request_context
 import ebooklib
+import hashlib
+import hmac
+import gzip
 from ebooklib import epub
-from bs4 import BeautifulSoup
 import os
 import uuid
 import warnings
 import magic
 import re
+import sqlite3
+import threading
+import bisect
+import atexit
+import time
+import functools
+import json
+import base64
+import multiprocessing
+import posixpath
+import zipfile
+from urllib.parse import unquote
+from xml.etree import ElementTree
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from database import Database
+from cache import LRUCache
+from html_parsers import get_parser
+from pagination import paginate, WORD
+from write_buffer import WriteBehindBuffer
+from metrics import Metrics, StageTimer, DURATION_BUCKETS, QUERY_BUCKETS, SIZE_BUCKETS, STAGE_BUCKETS
+
+try:
+    from PIL import Image
+except ImportError:  # responsive image variants are skipped without Pillow
+    Image = None
 
 warnings.filterwarnings('ignore', category=UserWarning, module='ebooklib')
 warnings.filterwarnings('ignore', category=FutureWarning, module='ebooklib')
@@ -15,19 +43,197 @@ warnings.filterwarnings('ignore', category=FutureWarning, module='ebooklib')
 app = Flask(__name__)
 app.secret_key = 'epub_reader_secret_key'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB limit
+app.config['INGEST_WORKERS'] = int(os.environ.get('READER_INGEST_WORKERS', os.cpu_count() or 1))  # parallel EPUB parsing processes
+app.config['STREAMING_INGEST'] = True  # read the zip one item at a time instead of loading it whole
+app.config['DATABASE'] = os.environ.get('READER_DB', 'reader.db')
+app.config['CACHE_MAX_BYTES'] = int(os.environ.get('READER_CACHE_BYTES', 64 * 1024 * 1024))
+app.config['HTML_PARSER'] = os.environ.get('READER_HTML_PARSER')  # None picks the fastest installed
+app.config['PROGRESS_FLUSH_SECONDS'] = float(os.environ.get('READER_PROGRESS_FLUSH_SECONDS', 2))  # 0 writes through
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('READER_SLOW_REQUEST_MS', 0))  # log slower requests, 0 disables
+app.config['WARM_UP_BOOKS'] = int(os.environ.get('READER_WARM_UP_BOOKS', 20))  # recently read books cached by warm_up()
+app.config['ADMIN_TOKEN'] = os.environ.get('READER_ADMIN_TOKEN')  # bearer token for /admin routes, unset disables them
+
+# Stored in PRAGMA user_version once init_db has run; bump it whenever init_db
+# changes so existing databases are migrated, and only then
+SCHEMA_VERSION = 6
+WORDS_PER_PAGE = 250
+READING_WORDS_PER_MINUTE = 238
+MAX_PREFETCH_CHAPTERS = 5
+MAX_PAGES_PER_REQUEST = 10
+IMAGE_VARIANT_WIDTHS = (480, 960)
+IMAGE_VARIANT_SOURCE_TYPES = ('image/png', 'image/jpeg', 'image/webp', 'image/bmp', 'image/tiff')
+# Tables with a book_id column, cleared together when a book goes away
+BOOK_CONTENT_TABLES = ('chapters', 'chapter_pages', 'chapter_mapping', 'chapter_text', 'book_images', 'book_stats')
+BOOK_USER_TABLES = ('reading_progress', 'bookmarks', 'book_sources')
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Listing sort orders as (keys, descending); each ends in a unique column
+BOOKMARK_SORTS = {
+    'created': (('b.created_at', 'b.id'), True),
+    'position': (('b.chapter', 'b.page', 'b.id'), False),
+}
+BOOK_SORTS = {
+    'title': (('title COLLATE NOCASE', 'books.rowid'), False),
+    'author': (('author COLLATE NOCASE', 'books.rowid'), False),
+    'recent': (('books.rowid',), True),
+}
+STALE_INGEST_HOURS = 24  # a streaming ingest older than this was interrupted
+JOB_RETENTION_DAYS = 7
+
+def reset_peak_memory():
+    # Resets the kernel's RSS high-water mark so each ingest reports its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_memory_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    # Only values SQLite can bind, so a forged cursor is a 400 rather than a 500
+    for value in values:
+        if not (value is None or isinstance(value, (str, float))
+                or isinstance(value, int) and -SQLITE_MAX_INTEGER - 1 <= value <= SQLITE_MAX_INTEGER):
+            raise ValueError("Invalid cursor")
+    return values
+
+def like_pattern(text):
+    return '%' + re.sub(r'([\\%_])', r'\\\1', text) + '%'
+
+def keyset_query(db, columns, tables, where, params, keys, descending, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """Cursor-paginated SELECT. keys is the sort order and must end in a
+    unique column. Rows after the cursor are found by comparing row values,
+    so with a matching index each page is a range scan however deep it is.
+    Returns (rows, next_cursor), where next_cursor is None on the last page."""
+    where, params = list(where), list(params)
+    if cursor:
+        values = decode_cursor(cursor, len(keys))
+        op = '<' if descending else '>'
+        # The leading-key bound lets SQLite range-scan collated indexes too
+        where.append(f"{keys[0]} {op}= ? AND ({', '.join(keys)}) {op} ({', '.join('?' * len(keys))})")
+        params += values[:1] + values
+    direction = ' DESC' if descending else ''
+    sql = (f"SELECT {columns}, {', '.join(keys)} FROM {tables}"
+           + (f" WHERE {' AND '.join(where)}" if where else '')
+           + f" ORDER BY {', '.join(key + direction for key in keys)} LIMIT ?")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = db.fetchall(sql, params + [limit + 1])
+    next_cursor = encode_cursor(list(rows[limit - 1][-len(keys):])) if len(rows) > limit else None
+    return [row[:-len(keys)] for row in rows[:limit]], next_cursor
+
+def summarize_chapters(counts):
+    """Book totals from per-chapter (words, characters, pages) counts. Each
+    chapter becomes [words, characters, pages, start_word, start_page]."""
+    chapters = []
+    start_word, start_page, characters = 0, 1, 0
+    for words, chapter_characters, pages in counts:
+        pages = max(1, pages)
+        chapters.append([words, chapter_characters, pages, start_word, start_page])
+        start_word += words
+        start_page += pages
+        characters += chapter_characters
+    return {
+        'words': start_word,
+        'characters': characters,
+        'pages': max(1, start_page - 1),
+        'reading_minutes': start_word / READING_WORDS_PER_MINUTE,
+        'chapters': chapters
+    }
+
+def count_characters(text):
+    # Characters excluding whitespace, which varies with the markup
+    return len(''.join(text.split()))
+
+def chapter_counts(chapter):
+    return chapter['word_count'], chapter['characters'], len(chapter['pages'])
+
+def fts_book(book_id):
+    # FTS5 expression for the rows of one book: its id as a phrase of tokens.
+    # Callers still compare book_id, as the phrase could also match a longer id
+    return 'book_id : "' + book_id.replace('"', '""') + '"'
+
+def words_before(chapters, chapter_num, page_num):
+    # Words ahead of a reading position, counting pages of a chapter as equal
+    if chapter_num >= len(chapters):
+        return sum(chapter[0] for chapter in chapters)
+    words, _, pages, start_word, _ = chapters[chapter_num]
+    return start_word + words * min(page_num - 1, pages) // pages
+
+def compress_chapter(html):
+    # mtime=0 keeps the output deterministic for identical chapters
+    return gzip.compress(html.encode('utf-8'), compresslevel=9, mtime=0)
+
+def decompress_chapter(content):
+    return gzip.decompress(content).decode('utf-8')
 
 class EPUBReader:
-    def __init__(self):
+    def __init__(self, db_path='reader.db', parser=None, progress_flush_seconds=0):
+        # The schema depends on gunzip_text: the chapter_search view, the
+        # chapter_text triggers and highlight()/snippet() on chapters_fts call
+        # it, so touching those from a connection without it (the sqlite3
+        # shell, say) fails with "no such function". Everything else is plain
+        # SQLite; see "Opening the database elsewhere" in the README
+        self.db = Database(db_path, functions={'gunzip_text': decompress_chapter})
+        self.parser = get_parser(parser)
+        # Page turns are merged per book in memory and written in batches; a
+        # locked or unavailable database keeps them pending
+        self.progress_buffer = (WriteBehindBuffer(self.write_progress, progress_flush_seconds,
+                                                  transient=(sqlite3.OperationalError,))
+                                if progress_flush_seconds else None)
         self.init_db()
     
     def init_db(self):
-        conn = sqlite3.connect('reader.db')
+        conn = self.db.connect()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS books
-                     (id TEXT PRIMARY KEY, title TEXT, author TEXT, chapters INTEGER)''')
+                     (id TEXT PRIMARY KEY, title TEXT, author TEXT, chapters INTEGER, version TEXT)''')
+        # Version stamps change whenever a book (or the library) is written and back the HTTP ETags
+        columns = [row[1] for row in c.execute("PRAGMA table_info(books)").fetchall()]
+        if 'version' not in columns:
+            c.execute("ALTER TABLE books ADD COLUMN version TEXT")
+            c.execute("UPDATE books SET version = lower(hex(randomblob(8)))")
+        c.execute('''CREATE TABLE IF NOT EXISTS library_meta
+                     (key TEXT PRIMARY KEY, value TEXT)''')
+        c.execute("INSERT OR IGNORE INTO library_meta VALUES ('version', lower(hex(randomblob(8))))")
         c.execute('''CREATE TABLE IF NOT EXISTS chapters
-                     (book_id TEXT, chapter_num INTEGER, title TEXT, content TEXT, word_count INTEGER, cum_word_count INTEGER,
-                      PRIMARY KEY (book_id, chapter_num))''')
+                     (book_id TEXT, chapter_num INTEGER, title TEXT, content BLOB, word_count INTEGER, cum_word_count INTEGER,
+                      content_encoding TEXT, PRIMARY KEY (book_id, chapter_num))''')
+        # Page-sized fragments of each chapter, split at ingest time
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chapter_pages'")
+        pages_exist = c.fetchone() is not None
+        c.execute('''CREATE TABLE IF NOT EXISTS chapter_pages
+                     (book_id TEXT, chapter_num INTEGER, page_num INTEGER, start_word INTEGER, word_count INTEGER,
+                      anchors TEXT, content BLOB, PRIMARY KEY (book_id, chapter_num, page_num))''')
+        # Content hash of each imported file, so the same EPUB is not ingested twice
+        c.execute('''CREATE TABLE IF NOT EXISTS book_sources
+                     (hash TEXT PRIMARY KEY, book_id TEXT, filename TEXT, size INTEGER,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute("CREATE INDEX IF NOT EXISTS book_sources_book_id ON book_sources (book_id)")
         c.execute('''CREATE TABLE IF NOT EXISTS chapter_mapping
                      (book_id TEXT, href TEXT, chapter_num INTEGER,
                       PRIMARY KEY (book_id, href))''')
@@ -37,9 +243,31 @@ class EPUBReader:
             c.execute("ALTER TABLE chapters ADD COLUMN cum_word_count INTEGER DEFAULT 0")
         except:
             pass
-        c.execute('''CREATE TABLE IF NOT EXISTS images
-                     (book_id TEXT, filename TEXT, data BLOB,
+        # Chapter bodies are stored gzip-compressed; compress rows written before that
+        columns = [row[1] for row in c.execute("PRAGMA table_info(chapters)").fetchall()]
+        if 'content_encoding' not in columns:
+            c.execute("ALTER TABLE chapters ADD COLUMN content_encoding TEXT")
+            for (rowid,) in c.execute("SELECT rowid FROM chapters").fetchall():
+                content = conn.execute("SELECT content FROM chapters WHERE rowid = ?", (rowid,)).fetchone()[0]
+                conn.execute("UPDATE chapters SET content = ?, content_encoding = 'gzip' WHERE rowid = ?",
+                             (compress_chapter(content), rowid))
+            conn.commit()
+        # Images are stored once per distinct content; book_images maps each
+        # book's sanitized filenames onto the shared blobs
+        c.execute('''CREATE TABLE IF NOT EXISTS image_blobs
+                     (hash TEXT PRIMARY KEY, media_type TEXT, size INTEGER, data BLOB)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS book_images
+                     (book_id TEXT, filename TEXT, hash TEXT,
                       PRIMARY KEY (book_id, filename))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS image_variants
+                     (hash TEXT, width INTEGER, variant_hash TEXT,
+                      PRIMARY KEY (hash, width))''')
+        # Reference lookups for finding blobs no book uses any more
+        c.execute("CREATE INDEX IF NOT EXISTS book_images_hash ON book_images (hash)")
+        c.execute("CREATE INDEX IF NOT EXISTS image_variants_variant_hash ON image_variants (variant_hash)")
+        # Books stream_epub is still writing, whose rows maintenance must leave alone
+        c.execute('''CREATE TABLE IF NOT EXISTS pending_books
+                     (book_id TEXT PRIMARY KEY, started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
         c.execute('''CREATE TABLE IF NOT EXISTS reading_progress
                      (book_id TEXT, chapter INTEGER, page INTEGER, 
                       PRIMARY KEY (book_id))''')
@@ -50,11 +278,315 @@ class EPUBReader:
                      (id INTEGER PRIMARY KEY, book_id TEXT, chapter INTEGER, 
                       page INTEGER, chapter_title TEXT, bookmark_title TEXT, 
                       description TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        # One index per listing sort order in BOOKMARK_SORTS and BOOK_SORTS; the
+        # implicit rowid at the end of each index is the pagination tie-breaker
+        c.execute("CREATE INDEX IF NOT EXISTS bookmarks_book_created ON bookmarks (book_id, created_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS bookmarks_book_position ON bookmarks (book_id, chapter, page)")
+        c.execute("CREATE INDEX IF NOT EXISTS bookmarks_created ON bookmarks (created_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS bookmarks_position ON bookmarks (chapter, page)")
+        c.execute("CREATE INDEX IF NOT EXISTS books_title ON books (title COLLATE NOCASE)")
+        c.execute("CREATE INDEX IF NOT EXISTS books_author ON books (author COLLATE NOCASE)")
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS ingest_jobs
+                     (id TEXT PRIMARY KEY, filename TEXT, status TEXT, stage TEXT,
+                      done INTEGER DEFAULT 0, total INTEGER DEFAULT 0, book_id TEXT, error TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, peak_memory_kb INTEGER, hash TEXT)''')
+        columns = [row[1] for row in c.execute("PRAGMA table_info(ingest_jobs)").fetchall()]
+        if 'peak_memory_kb' not in columns:
+            c.execute("ALTER TABLE ingest_jobs ADD COLUMN peak_memory_kb INTEGER")
+        if 'hash' not in columns:
+            c.execute("ALTER TABLE ingest_jobs ADD COLUMN hash TEXT")
+        # At most one unfinished job per uploaded file, see create_job
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS ingest_jobs_active_hash ON ingest_jobs (hash)
+                     WHERE status IN ('queued', 'running')''')
+        
+        # Text statistics per book, with the per-chapter breakdown and offsets as
+        # JSON, and their library-wide totals, written at ingest time
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_stats'")
+        stats_exist = c.fetchone() is not None
+        c.execute('''CREATE TABLE IF NOT EXISTS book_stats
+                     (book_id TEXT PRIMARY KEY, words INTEGER, characters INTEGER, pages INTEGER,
+                      reading_minutes REAL, chapters TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS library_stats
+                     (id INTEGER PRIMARY KEY CHECK (id = 1), books INTEGER, words INTEGER, characters INTEGER,
+                      pages INTEGER, reading_minutes REAL)''')
+        c.execute("INSERT OR IGNORE INTO library_stats VALUES (1, 0, 0, 0, 0, 0)")
+        
+        # Plain text of each chapter, gzip-compressed like the bodies, and its
+        # full-text index. The index keeps no copy of the text: it reads it back
+        # through the chapter_search view, and triggers keep it in step with
+        # chapter_text. book_id is indexed so one book's rows are found through
+        # the index, see fts_book
+        c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chapters_fts'")
+        fts_sql = c.fetchone()
+        fts_exists = fts_sql is not None
+        legacy_fts = fts_exists and 'content_rowid' not in fts_sql[0]
+        c.execute('''CREATE TABLE IF NOT EXISTS chapter_text
+                     (id INTEGER PRIMARY KEY, book_id TEXT, chapter_num INTEGER, title TEXT, text BLOB)''')
+        c.execute("CREATE INDEX IF NOT EXISTS chapter_text_book ON chapter_text (book_id, chapter_num)")
+        if legacy_fts:
+            # Earlier versions stored the text uncompressed inside the index
+            rows = conn.execute("SELECT rowid, book_id, chapter_num, title, text FROM chapters_fts")
+            c.executemany("INSERT INTO chapter_text VALUES (?, ?, ?, ?, ?)",
+                          ((rowid, book_id, chapter_num, title, compress_chapter(text))
+                           for rowid, book_id, chapter_num, title, text in rows))
+            c.execute("DROP TABLE chapters_fts")
+        c.execute('''CREATE VIEW IF NOT EXISTS chapter_search AS
+                     SELECT id, book_id, chapter_num, title, gunzip_text(text) AS text FROM chapter_text''')
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS chapters_fts USING fts5
+                     (book_id, chapter_num UNINDEXED, title, text,
+                      content = 'chapter_search', content_rowid = 'id',
+                      tokenize = 'unicode61 remove_diacritics 2')''')
+        if legacy_fts:
+            c.execute("INSERT INTO chapters_fts (chapters_fts) VALUES ('rebuild')")
+        c.execute('''CREATE TRIGGER IF NOT EXISTS chapter_text_insert AFTER INSERT ON chapter_text BEGIN
+                         INSERT INTO chapters_fts (rowid, book_id, chapter_num, title, text)
+                         VALUES (new.id, new.book_id, new.chapter_num, new.title, gunzip_text(new.text));
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS chapter_text_delete AFTER DELETE ON chapter_text BEGIN
+                         INSERT INTO chapters_fts (chapters_fts, rowid, book_id, chapter_num, title, text)
+                         VALUES ('delete', old.id, old.book_id, old.chapter_num, old.title, gunzip_text(old.text));
+                     END''')
         conn.commit()
-        conn.close()
+        c.close()
+        
+        if not fts_exists:
+            self.rebuild_search_index()
+        if not pages_exist:
+            self.rebuild_page_index()
+        if not stats_exist:
+            self.rebuild_book_stats()
+        
+        if self.db.fetchone("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'images'"):
+            self.migrate_legacy_images()
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    
+    def migrate_legacy_images(self):
+        """Move per-book image BLOBs from the old images table into the content-addressed store"""
+        with self.db.transaction() as c:
+            rows = self.db.connect().execute("SELECT book_id, filename, data FROM images")
+            for book_id, filename, data in rows:
+                image_hash = self.store_image_blob(c, data, magic.from_buffer(data[:2048], mime=True))
+                c.execute("INSERT OR IGNORE INTO book_images VALUES (?, ?, ?)", (book_id, filename, image_hash))
+            c.execute("DROP TABLE images")
+    
+    def store_image_blob(self, c, data, media_type, image_hash=None):
+        image_hash = image_hash or hashlib.sha256(data).hexdigest()
+        c.execute("SELECT 1 FROM image_blobs WHERE hash = ?", (image_hash,))
+        if not c.fetchone():
+            c.execute("INSERT INTO image_blobs VALUES (?, ?, ?, ?)", (image_hash, media_type, len(data), data))
+        return image_hash
+    
+    def make_image_variants(self, image_hash, data, media_type):
+        # Returns the source width and {width: WebP bytes} for each variant
+        # narrower than the source. Variants already stored for this content
+        # map to None so they are not transcoded again.
+        if Image is None or media_type not in IMAGE_VARIANT_SOURCE_TYPES:
+            return None, {}
+        try:
+            img = Image.open(BytesIO(data))
+            source_width, source_height = img.size
+        except Exception:
+            return None, {}
+        
+        existing = self.db.fetchall("SELECT width FROM image_variants WHERE hash = ?", (image_hash,))
+        if existing:
+            return source_width, {width: None for (width,) in existing}
+        
+        widths = [width for width in IMAGE_VARIANT_WIDTHS if width < source_width]
+        if not widths:
+            return source_width, {}
+        
+        variants = {}
+        try:
+            # Lets JPEG decode at a reduced scale that still covers the largest variant
+            img.draft('RGB', (max(widths), source_height * max(widths) // source_width))
+            img = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+            for width in widths:
+                height = max(1, round(source_height * width / source_width))
+                out = BytesIO()
+                img.resize((width, height), Image.LANCZOS).save(out, 'WEBP', quality=80, method=4)
+                # Only keep variants that actually save bytes
+                if out.tell() < len(data):
+                    variants[width] = out.getvalue()
+        except Exception:
+            return source_width, {}
+        return source_width, variants
+    
+    def rebuild_search_index(self, book_id=None):
+        """Index chapters stored before the full-text table existed"""
+        with self.db.transaction() as c:
+            # The triggers on chapter_text update the index
+            if book_id:
+                c.execute("DELETE FROM chapter_text WHERE book_id = ?", (book_id,))
+                c.execute("SELECT book_id, chapter_num, title, content FROM chapters WHERE book_id = ?", (book_id,))
+            else:
+                c.execute("DELETE FROM chapter_text")
+                c.execute("SELECT book_id, chapter_num, title, content FROM chapters")
+            for row_book_id, chapter_num, title, content in c.fetchall():
+                text = self.parser.text(self.parser.parse(decompress_chapter(content)))
+                c.execute("INSERT INTO chapter_text (book_id, chapter_num, title, text) VALUES (?, ?, ?, ?)",
+                          (row_book_id, chapter_num, title, compress_chapter(text)))
+    
+    def rebuild_page_index(self, book_id=None):
+        """Paginate chapters stored before the page index existed"""
+        with self.db.transaction() as c:
+            if book_id:
+                c.execute("DELETE FROM chapter_pages WHERE book_id = ?", (book_id,))
+                c.execute("SELECT book_id, chapter_num, content FROM chapters WHERE book_id = ?", (book_id,))
+            else:
+                c.execute("DELETE FROM chapter_pages")
+                c.execute("SELECT book_id, chapter_num, content FROM chapters")
+            for row_book_id, chapter_num, content in c.fetchall():
+                self.store_pages(c, row_book_id, chapter_num, self.prepare_pages(decompress_chapter(content)))
+    
+    def rebuild_book_stats(self, book_id=None):
+        """Compute statistics for books stored before the stats table existed,
+        from the stored word counts, page index and plain text"""
+        with self.db.transaction() as c:
+            if book_id:
+                c.execute("DELETE FROM book_stats WHERE book_id = ?", (book_id,))
+                book_ids = [book_id]
+            else:
+                c.execute("DELETE FROM book_stats")
+                book_ids = [row[0] for row in c.execute("SELECT id FROM books").fetchall()]
+            for row_book_id in book_ids:
+                characters = dict(c.execute(
+                    "SELECT chapter_num, gunzip_text(text) FROM chapter_text WHERE book_id = ?",
+                    (row_book_id,)).fetchall())
+                rows = c.execute("""SELECT c.chapter_num, c.word_count, COUNT(p.page_num)
+                                     FROM chapters c
+                                     LEFT JOIN chapter_pages p ON p.book_id = c.book_id AND p.chapter_num = c.chapter_num
+                                     WHERE c.book_id = ?
+                                     GROUP BY c.chapter_num ORDER BY c.chapter_num""", (row_book_id,)).fetchall()
+                self.store_book_stats(c, row_book_id, [
+                    (word_count or 0, count_characters(characters.get(chapter_num) or ''), page_count)
+                    for chapter_num, word_count, page_count in rows])
+            self.refresh_library_stats(c)
+    
+    def store_book_stats(self, c, book_id, counts):
+        stats = summarize_chapters(counts)
+        c.execute("INSERT OR REPLACE INTO book_stats VALUES (?, ?, ?, ?, ?, ?)",
+                  (book_id, stats['words'], stats['characters'], stats['pages'], stats['reading_minutes'],
+                   json.dumps(stats['chapters'], separators=(',', ':'))))
+        self.add_library_stats(c, 1, stats['words'], stats['characters'], stats['pages'], stats['reading_minutes'])
     
-    def parse_epub(self, file_path):
+    def add_library_stats(self, c, books, words, characters, pages, reading_minutes):
+        c.execute("""UPDATE library_stats SET books = books + ?, words = words + ?, characters = characters + ?,
+                     pages = pages + ?, reading_minutes = reading_minutes + ? WHERE id = 1""",
+                  (books, words, characters, pages, reading_minutes))
+    
+    def refresh_library_stats(self, c):
+        # Recomputes the running totals from scratch
+        c.execute("""UPDATE library_stats SET (books, words, characters, pages, reading_minutes) =
+                     (SELECT COUNT(*), IFNULL(SUM(words), 0), IFNULL(SUM(characters), 0), IFNULL(SUM(pages), 0),
+                             IFNULL(SUM(reading_minutes), 0) FROM book_stats)
+                     WHERE id = 1""")
+    
+    def prepare_pages(self, html):
+        return [(compress_chapter(page['content']), page['start_word'], page['word_count'], ' '.join(page['anchors']))
+                for page in paginate(html, WORDS_PER_PAGE)]
+    
+    def store_pages(self, c, book_id, chapter_num, pages):
+        c.executemany("INSERT INTO chapter_pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      [(book_id, chapter_num, page_num, start_word, word_count, anchors, content)
+                       for page_num, (content, start_word, word_count, anchors) in enumerate(pages, 1)])
+    
+    def prepare_image(self, book_id, href, media_type, data, srcsets):
+        # Trust the manifest media type, sniff only when it is missing or bogus
+        if not media_type or not media_type.startswith('image/'):
+            media_type = magic.from_buffer(data[:2048], mime=True)
+        # Store with original filename, sanitize
+        names = {re.sub(r'[^a-zA-Z0-9_.]', '_', href.split('/')[-1])}
+        # Also store with full path as filename for nested images
+        names.add(re.sub(r'[^a-zA-Z0-9_.]', '_', href.replace('/', '_').replace('\\', '_')))
+        image_hash = hashlib.sha256(data).hexdigest()
+        source_width, variants = self.make_image_variants(image_hash, data, media_type)
+        
+        if variants:
+            for name in names:
+                srcsets.setdefault(name, ', '.join(
+                    [f'/image/{book_id}/{name}?w={width} {width}w' for width in sorted(variants)] +
+                    [f'/image/{book_id}/{name} {source_width}w']))
+        return names, media_type, data, image_hash, variants
+    
+    def store_image(self, c, book_id, image):
+        names, media_type, data, image_hash, variants = image
+        self.store_image_blob(c, data, media_type, image_hash)
+        c.executemany("INSERT OR IGNORE INTO book_images VALUES (?, ?, ?)",
+                      [(book_id, name, image_hash) for name in names])
+        for width, variant_data in variants.items():
+            if variant_data is not None:
+                variant_hash = self.store_image_blob(c, variant_data, 'image/webp')
+                c.execute("INSERT OR IGNORE INTO image_variants VALUES (?, ?, ?)",
+                          (image_hash, width, variant_hash))
+    
+    def prepare_chapter(self, book_id, href, doc, srcsets):
+        parser = self.parser
+        # Fix image paths
+        for img in parser.images(doc):
+            src = parser.get_attr(img, 'src')
+            if src:
+                original_name = re.sub(r'[^a-zA-Z0-9_.]', '_', src.split('/')[-1])
+                full_path_name = re.sub(r'[^a-zA-Z0-9_.]', '_', src.replace('/', '_').replace('\\', '_'))
+                parser.set_attr(img, 'src', f'/image/{book_id}/{original_name}')
+                parser.set_attr(img, 'onerror', f"this.removeAttribute('srcset');this.src='/image/{book_id}/{full_path_name}'")
+                parser.set_attr(img, 'style', 'max-width: 100%; height: auto;')
+                if original_name in srcsets:
+                    parser.set_attr(img, 'srcset', srcsets[original_name])
+                    parser.set_attr(img, 'sizes', '(max-width: 800px) 100vw, 800px')
+        
+        text = parser.text(doc)
+        if not text.strip():
+            return None
+        html = parser.serialize(doc)
+        return {
+            'title': self.extract_title(doc),
+            'content': compress_chapter(html),
+            'pages': self.prepare_pages(html),
+            'text': compress_chapter(text),
+            'word_count': len(re.findall(r'\b\w+\b', text)),
+            'characters': count_characters(text),
+            'href': href
+        }
+    
+    def store_chapter(self, c, book_id, chapter_num, chapter, cum_word_count):
+        c.execute('''INSERT INTO chapters (book_id, chapter_num, title, content, word_count, cum_word_count, content_encoding)
+                     VALUES (?, ?, ?, ?, ?, ?, 'gzip')''',
+                 (book_id, chapter_num, chapter['title'], chapter['content'], chapter['word_count'], cum_word_count))
+        self.store_pages(c, book_id, chapter_num, chapter['pages'])
+        # Plain text for search, indexed by the chapter_text_insert trigger
+        c.execute("INSERT INTO chapter_text (book_id, chapter_num, title, text) VALUES (?, ?, ?, ?)",
+                 (book_id, chapter_num, chapter['title'], chapter['text']))
+        # Store chapter mapping
+        c.execute("INSERT INTO chapter_mapping VALUES (?, ?, ?)",
+                 (book_id, chapter['href'], chapter_num))
+        # Also store filename mapping
+        filename = chapter['href'].split('/')[-1]
+        if filename != chapter['href']:
+            c.execute("INSERT OR IGNORE INTO chapter_mapping VALUES (?, ?, ?)",
+                     (book_id, filename, chapter_num))
+    
+    def store_book(self, c, book_id, title, author, chapter_count, source=None):
+        c.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)", 
+                 (book_id, title, author, chapter_count, uuid.uuid4().hex[:16]))
+        # source is (hash, filename, size) of the imported file, written in the
+        # same transaction so a book is only recorded once it is complete
+        if source:
+            content_hash, filename, size = source
+            c.execute("INSERT OR REPLACE INTO book_sources (hash, book_id, filename, size) VALUES (?, ?, ?, ?)",
+                      (content_hash, book_id, filename, size))
+        self.bump_library_version(c)
+    
+    def parse_epub(self, file_path, progress=None, source=None):
+        # progress(stage, done, total) is called as each stage advances:
+        # unzip, images, chapters, db_write
+        progress = StageTimer(progress)
+        reset_peak_memory()
+        
+        progress('unzip', 0, 1)
         book = epub.read_epub(file_path, options={'ignore_ncx': True})
+        progress('unzip', 1, 1)
         
         # Extract metadata
         title = book.get_metadata('DC', 'title')[0][0] if book.get_metadata('DC', 'title') else 'Unknown'
@@ -62,130 +594,442 @@ class EPUBReader:
         
         book_id = str(uuid.uuid4())
         
-        # Extract and store images
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
+        # Extract images
+        images = []
+        srcsets = {}
+        image_items = [item for item in book.get_items() if item.get_type() == ebooklib.ITEM_IMAGE]
+        for n, item in enumerate(image_items):
+            images.append(self.prepare_image(book_id, item.get_name(), item.media_type, item.get_content(), srcsets))
+            progress('images', n + 1, len(image_items))
         
-        try:
-            # Start transaction
-            conn.execute("BEGIN")
-            
-            # Extract and store images
-            c.execute("DELETE FROM images WHERE book_id = ?", (book_id,))
-            
-            for item in book.get_items():
-                if item.get_type() == ebooklib.ITEM_IMAGE:
-                    # Store with original filename, sanitize
-                    original_name = re.sub(r'[^a-zA-Z0-9_.]', '_', item.get_name().split('/')[-1])
-                    c.execute("INSERT INTO images VALUES (?, ?, ?)",
-                             (book_id, original_name, item.get_content()))
-                    # Also store with full path as filename for nested images
-                    full_path_name = re.sub(r'[^a-zA-Z0-9_.]', '_', item.get_name().replace('/', '_').replace('\\', '_'))
-                    if full_path_name != original_name:
-                        c.execute("INSERT OR IGNORE INTO images VALUES (?, ?, ?)",
-                                 (book_id, full_path_name, item.get_content()))
-            
-            # Extract chapters
-            chapters = []
-            spine_items = []
-            
-            for i, item in enumerate(book.spine):
-                spine_item = book.get_item_with_id(item[0])
-                if spine_item and spine_item.get_type() == ebooklib.ITEM_DOCUMENT:
-                    spine_items.append(spine_item)
-                    soup = BeautifulSoup(spine_item.get_content(), 'html.parser')
-                    
-                    # Fix image paths
-                    for img in soup.find_all('img'):
-                        src = img.get('src')
-                        if src:
-                            original_name = re.sub(r'[^a-zA-Z0-9_.]', '_', src.split('/')[-1])
-                            full_path_name = re.sub(r'[^a-zA-Z0-9_.]', '_', src.replace('/', '_').replace('\\', '_'))
-                            img['src'] = f'/image/{book_id}/{original_name}'
-                            img['onerror'] = f"this.src='/image/{book_id}/{full_path_name}'"
-                            img['style'] = 'max-width: 100%; height: auto;'
-                    
-                    text = soup.get_text()
-                    if text.strip():
-                        chapters.append({
-                            'title': self.extract_title(soup),
-                            'content': str(soup),
-                            'word_count': len(re.findall(r'\b\w+\b', text)),
-                            'href': spine_item.get_name()
-                        })
+        # Extract chapters
+        chapters = []
+        
+        for n, item in enumerate(book.spine):
+            spine_item = book.get_item_with_id(item[0])
+            if spine_item and spine_item.get_type() == ebooklib.ITEM_DOCUMENT:
+                doc = self.parser.parse(spine_item.get_content())
+                chapter = self.prepare_chapter(book_id, spine_item.get_name(), doc, srcsets)
+                if chapter:
+                    chapters.append(chapter)
+            progress('chapters', n + 1, len(book.spine))
+        
+        # Parsing happens before the transaction so parallel ingest workers
+        # only hold the write lock for the inserts themselves
+        progress('db_write', 0, len(chapters))
+        with self.db.transaction() as c:
+            for image in images:
+                self.store_image(c, book_id, image)
             
             # Save to database
-            c.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?)", 
-                     (book_id, title, author, len(chapters)))
+            self.store_book(c, book_id, title, author, len(chapters), source)
             
             # Store chapters and mapping in database
-            c.execute("DELETE FROM chapters WHERE book_id = ?", (book_id,))
-            c.execute("DELETE FROM chapter_mapping WHERE book_id = ?", (book_id,))
             cum = 0
             for i, chapter in enumerate(chapters):
                 cum += chapter['word_count']
-                c.execute("INSERT INTO chapters VALUES (?, ?, ?, ?, ?, ?)",
-                         (book_id, i, chapter['title'], chapter['content'], chapter['word_count'], cum))
-                # Store chapter mapping
-                c.execute("INSERT INTO chapter_mapping VALUES (?, ?, ?)",
-                         (book_id, chapter['href'], i))
-                # Also store filename mapping
-                filename = chapter['href'].split('/')[-1]
-                if filename != chapter['href']:
-                    c.execute("INSERT OR IGNORE INTO chapter_mapping VALUES (?, ?, ?)",
-                             (book_id, filename, i))
+                self.store_chapter(c, book_id, i, chapter, cum)
+            self.store_book_stats(c, book_id, [chapter_counts(chapter) for chapter in chapters])
+        progress('db_write', len(chapters), len(chapters))
+        
+        return {
+            'id': book_id,
+            'title': title,
+            'author': author,
+            'chapter_count': len(chapters),
+            'peak_memory_kb': peak_memory_kb(),
+            'stage_seconds': progress.seconds
+        }
+    
+    def stream_epub(self, file_path, progress=None, source=None):
+        """Memory-bounded variant of parse_epub.
+
+        Reads the OPF and each spine document or image straight from the zip one
+        at a time, writing each to the database before reading the next, so at
+        most one chapter is held in memory. The books row is written last, so a
+        partially ingested book never shows up in the library; on failure every
+        row written for it is removed.
+        """
+        progress = StageTimer(progress)
+        reset_peak_memory()
+        book_id = str(uuid.uuid4())
+        
+        progress('unzip', 0, 1)
+        with zipfile.ZipFile(file_path) as zf:
+            container = ElementTree.fromstring(zf.read('META-INF/container.xml'))
+            rootfile = container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+            opf_path = rootfile.get('full-path')
+            opf_dir = posixpath.dirname(opf_path)
+            opf = ElementTree.fromstring(zf.read(opf_path))
+            progress('unzip', 1, 1)
             
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            ns = {'opf': 'http://www.idpf.org/2007/opf', 'dc': 'http://purl.org/dc/elements/1.1/'}
+            title = opf.findtext('.//dc:title', None, ns) or 'Unknown'
+            author = opf.findtext('.//dc:creator', None, ns) or 'Unknown'
+            manifest = {}
+            for item in opf.iterfind('opf:manifest/opf:item', ns):
+                media_type = item.get('media-type', '')
+                manifest[item.get('id')] = (unquote(item.get('href', '')), 'image/jpeg' if media_type == 'image/jpg' else media_type,
+                                            item.get('properties', '').split())
+            spine = [itemref.get('idref') for itemref in opf.iterfind('opf:spine/opf:itemref', ns)]
+            
+            def read(href):
+                return zf.read(posixpath.normpath(posixpath.join(opf_dir, href)))
+            
+            try:
+                with self.db.transaction() as c:
+                    c.execute("INSERT INTO pending_books (book_id) VALUES (?)", (book_id,))
+                srcsets = {}
+                image_ids = [item_id for item_id, (href, media_type, properties) in manifest.items()
+                             if media_type.startswith('image/')]
+                for n, item_id in enumerate(image_ids):
+                    href, media_type, properties = manifest[item_id]
+                    image = self.prepare_image(book_id, href, media_type, read(href), srcsets)
+                    with self.db.transaction() as c:
+                        self.store_image(c, book_id, image)
+                    del image
+                    progress('images', n + 1, len(image_ids))
+                
+                chapter_count = 0
+                cum = 0
+                counts = []
+                for n, item_id in enumerate(spine):
+                    href, media_type, properties = manifest.get(item_id, ('', '', []))
+                    # Every XHTML spine item is a chapter, the nav document included, as
+                    # ebooklib reads it for parse_epub
+                    if media_type == 'application/xhtml+xml':
+                        doc = self.parser.parse(read(href))
+                        # Match ebooklib, which rebuilds the document around the body only
+                        self.parser.clear_head(doc)
+                        chapter = self.prepare_chapter(book_id, href, doc, srcsets)
+                        del doc
+                        if chapter:
+                            cum += chapter['word_count']
+                            with self.db.transaction() as c:
+                                self.store_chapter(c, book_id, chapter_count, chapter, cum)
+                            counts.append(chapter_counts(chapter))
+                            chapter_count += 1
+                        del chapter
+                    progress('chapters', n + 1, len(spine))
+                
+                progress('db_write', 0, 1)
+                with self.db.transaction() as c:
+                    self.store_book(c, book_id, title, author, chapter_count, source)
+                    self.store_book_stats(c, book_id, counts)
+                    c.execute("DELETE FROM pending_books WHERE book_id = ?", (book_id,))
+                progress('db_write', 1, 1)
+            except BaseException:
+                with self.db.transaction() as c:
+                    for table in BOOK_CONTENT_TABLES + ('pending_books',):
+                        c.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+                    self.purge_images(c)
+                raise
         
         return {
             'id': book_id,
             'title': title,
             'author': author,
-            'chapter_count': len(chapters)
+            'chapter_count': chapter_count,
+            'peak_memory_kb': peak_memory_kb(),
+            'stage_seconds': progress.seconds
         }
     
-    def extract_title(self, soup):
-        title_tag = soup.find('title')
-        if title_tag:
-            return title_tag.get_text().strip()
+    def find_book_by_hash(self, content_hash):
+        row = self.db.fetchone("""SELECT b.id FROM book_sources s JOIN books b ON b.id = s.book_id
+                                  WHERE s.hash = ?""", (content_hash,))
+        return row[0] if row else None
+    
+    def create_job(self, filename, content_hash=None):
+        """Queue a job, returning (job_id, created).
+
+        A file that is already queued or being parsed, possibly by another
+        worker, is not queued twice: the unfinished job is returned instead.
+        """
+        job_id = str(uuid.uuid4())
+        try:
+            self.db.execute("INSERT INTO ingest_jobs (id, filename, status, hash) VALUES (?, ?, 'queued', ?)",
+                            (job_id, filename, content_hash))
+        except sqlite3.IntegrityError:
+            row = self.db.fetchone("""SELECT id FROM ingest_jobs
+                                      WHERE hash = ? AND status IN ('queued', 'running')""", (content_hash,))
+            if row:
+                return row[0], False
+            # The other job finished in between
+            return self.create_job(filename, content_hash)
+        return job_id, True
+    
+    def delete_job(self, job_id):
+        self.db.execute("DELETE FROM ingest_jobs WHERE id = ?", (job_id,))
+    
+    def fail_unfinished_jobs(self):
+        # Ingest pools do not outlive the server, so at startup any job still
+        # queued or running was lost with the previous process
+        return self.db.execute("""UPDATE ingest_jobs SET status = 'error', error = 'Interrupted by a server restart'
+                                  WHERE status IN ('queued', 'running')""")
+    
+    def update_job(self, job_id, **fields):
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self.db.execute(f"UPDATE ingest_jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    
+    def get_job(self, job_id):
+        row = self.db.fetchone("""SELECT j.id, j.filename, j.status, j.stage, j.done, j.total, j.error,
+                                         j.peak_memory_kb, b.id, b.title, b.author, b.chapters
+                                  FROM ingest_jobs j
+                                  LEFT JOIN books b ON b.id = j.book_id
+                                  WHERE j.id = ?""", (job_id,))
+        if not row:
+            return None
+        return {
+            'id': row[0], 'filename': row[1], 'status': row[2], 'stage': row[3],
+            'done': row[4], 'total': row[5], 'error': row[6], 'peak_memory_kb': row[7],
+            'book': {'id': row[8], 'title': row[9], 'author': row[10], 'chapter_count': row[11]} if row[8] else None
+        }
+    
+    def extract_title(self, doc):
+        title = self.parser.find_text(doc, 'title')
+        if title is not None:
+            return title.strip()
         
         for tag in ['h1', 'h2', 'h3']:
-            header = soup.find(tag)
-            if header:
-                return header.get_text().strip()
+            header = self.parser.find_text(doc, tag)
+            if header is not None:
+                return header.strip()
         
         return 'Chapter'
     
+    def fts_query(self, query):
+        # Quote user input as a single phrase so FTS5 operators are not interpreted,
+        # and prefix-match the last word like the old substring search did. The
+        # book_id column is left out
+        words = re.findall(r'\w+', query)
+        if not words:
+            return None
+        return '{title text} : "' + ' '.join(words) + '"*'
+    
+    def search_book(self, book_id, query, limit=200):
+        match = self.fts_query(query)
+        if not match:
+            return []
+        
+        page_starts = {}
+        for chapter_num, start_word in self.db.fetchall(
+                "SELECT chapter_num, start_word FROM chapter_pages WHERE book_id = ? ORDER BY chapter_num, page_num",
+                (book_id,)):
+            page_starts.setdefault(chapter_num, []).append(start_word)
+        
+        c = self.db.connect().cursor()
+        # Filtering inside the MATCH ranks only this book's rows
+        c.execute("""SELECT chapter_num, title, highlight(chapters_fts, 3, char(2), char(3))
+                     FROM chapters_fts
+                     WHERE chapters_fts MATCH ? AND book_id = ?
+                     ORDER BY rank""", (f'{fts_book(book_id)} AND {match}', book_id))
+        
+        results = []
+        for chapter_num, title, highlighted in c:
+            # Every highlighted match gets its own result with surrounding words as context
+            words = highlighted.split()
+            starts = page_starts.get(chapter_num)
+            counted = position = 0
+            for i, word in enumerate(words):
+                if '\x02' in word:
+                    start = max(0, i - 10)
+                    end = min(len(words), i + 10)
+                    context = ' '.join(words[start:end]).replace('\x02', '').replace('\x03', '')
+                    # Word offset of the match, to find its page in the page index
+                    position += len(WORD.findall(' '.join(words[counted:i])))
+                    counted = i
+                    results.append({
+                        'chapter': chapter_num,
+                        'page': max(1, bisect.bisect_right(starts, position)) if starts else 1,
+                        'title': title,
+                        'context': context
+                    })
+                    if len(results) >= limit:
+                        c.close()
+                        return results
+        c.close()
+        return results
+    
+    def search_library(self, query, limit=50):
+        match = self.fts_query(query)
+        if not match:
+            return []
+        
+        rows = self.db.fetchall("""SELECT f.book_id, b.title, b.author, f.chapter_num, f.title,
+                                          snippet(chapters_fts, 3, '', '', '...', 20)
+                                   FROM chapters_fts f
+                                   JOIN books b ON b.id = f.book_id
+                                   WHERE chapters_fts MATCH ?
+                                   ORDER BY f.rank
+                                   LIMIT ?""", (match, limit))
+        return [{
+            'book_id': row[0], 'book_title': row[1], 'author': row[2],
+            'chapter': row[3], 'title': row[4], 'context': ' '.join(row[5].split())
+        } for row in rows]
+    
+    def get_book_version(self, book_id):
+        result = self.db.fetchone("SELECT version FROM books WHERE id = ?", (book_id,))
+        return result[0] if result else None
+    
+    def get_library_version(self):
+        return self.db.fetchone("SELECT value FROM library_meta WHERE key = 'version'")[0]
+    
+    def bump_library_version(self, c):
+        c.execute("UPDATE library_meta SET value = lower(hex(randomblob(8))) WHERE key = 'version'")
+    
+    def get_book(self, book_id):
+        result = self.db.fetchone("""SELECT b.title, b.author, b.chapters, s.words, s.chapters
+                                     FROM books b LEFT JOIN book_stats s ON s.book_id = b.id
+                                     WHERE b.id = ?""", (book_id,))
+        if not result:
+            return None
+        progress = self.get_reading_progress(book_id)
+        words_read = words_before(json.loads(result[4]) if result[4] else [], *progress)
+        words_left = max(0, (result[3] or 0) - words_read)
+        return {
+            'id': book_id,
+            'title': result[0],
+            'author': result[1],
+            'chapter_count': result[2],
+            'last_chapter': progress[0],
+            'last_page': progress[1],
+            'percent_read': round(100 * words_read / result[3], 1) if result[3] else 0,
+            'minutes_left': round(words_left / READING_WORDS_PER_MINUTE, 1)
+        }
+    
+    def get_chapter(self, book_id, chapter_num):
+        result = self.db.fetchone("SELECT title, content, word_count FROM chapters WHERE book_id = ? AND chapter_num = ?",
+                                  (book_id, chapter_num))
+        if not result:
+            return None
+        
+        title, content, word_count = result
+        page_map = self.get_page_map(book_id)
+        
+        return {
+            'index': chapter_num,
+            'title': title,
+            'content': decompress_chapter(content),
+            'total_pages': page_map[chapter_num]['total_pages'],
+            'start_page': page_map[chapter_num]['start_page'],
+            'word_count': word_count
+        }
+    
+    def get_page(self, book_id, chapter_num, page_num):
+        result = self.db.fetchone("SELECT content FROM chapter_pages WHERE book_id = ? AND chapter_num = ? AND page_num = ?",
+                                  (book_id, chapter_num, page_num))
+        if not result:
+            return None
+        return {'page': page_num, 'content': decompress_chapter(result[0])}
+    
+    def find_anchor_page(self, book_id, chapter_num, anchor):
+        result = self.db.fetchone("""SELECT page_num FROM chapter_pages
+                                     WHERE book_id = ? AND chapter_num = ? AND instr(' ' || anchors || ' ', ?) > 0
+                                     ORDER BY page_num LIMIT 1""", (book_id, chapter_num, f' {anchor} '))
+        return result[0] if result else None
+    
+    def get_toc(self, book_id):
+        rows = self.db.fetchall("SELECT chapter_num, title FROM chapters WHERE book_id = ? ORDER BY chapter_num",
+                                (book_id,))
+        return [{'index': row[0], 'title': row[1]} for row in rows]
+    
+    def get_chapter_mapping(self, book_id):
+        rows = self.db.fetchall("SELECT href, chapter_num FROM chapter_mapping WHERE book_id = ?", (book_id,))
+        mapping = {row[0]: row[1] for row in rows}
+        
+        # If no mapping exists, create a simple numeric mapping
+        if not mapping:
+            chapters = self.db.fetchall("SELECT chapter_num FROM chapters WHERE book_id = ? ORDER BY chapter_num", (book_id,))
+            for i, (chapter_num,) in enumerate(chapters):
+                # Create simple mapping: ch01.xhtml -> 0, ch02.xhtml -> 1, etc.
+                filename = f"ch{i+1:02d}.xhtml"
+                mapping[filename] = chapter_num
+                # Also try common variations
+                mapping[f"chapter{i+1}.xhtml"] = chapter_num
+                mapping[f"ch{i+1}.xhtml"] = chapter_num
+                mapping[f"chapter_{i+1}.xhtml"] = chapter_num
+        return mapping
+    
+    def get_book_stats(self, book_id):
+        # Computed once at ingest, see store_book_stats
+        result = self.db.fetchone("""SELECT words, characters, pages, reading_minutes, chapters
+                                     FROM book_stats WHERE book_id = ?""", (book_id,))
+        if not result:
+            return {'total_pages': 1, 'total_words': 0, 'total_characters': 0, 'reading_minutes': 0, 'chapters': []}
+        return {
+            'total_pages': result[2],
+            'total_words': result[0],
+            'total_characters': result[1],
+            'reading_minutes': round(result[3], 1),
+            'chapters': [{
+                'chapter': n, 'words': words, 'characters': characters, 'total_pages': pages,
+                'start_word': start_word, 'start_page': start_page
+            } for n, (words, characters, pages, start_word, start_page) in enumerate(json.loads(result[4]))]
+        }
+    
+    def get_page_map(self, book_id):
+        return [{key: chapter[key] for key in ('chapter', 'total_pages', 'start_page')}
+                for chapter in self.get_book_stats(book_id)['chapters']]
+    
+    def get_library_stats(self):
+        result = self.db.fetchone("""SELECT books, words, characters, pages, reading_minutes
+                                     FROM library_stats WHERE id = 1""")
+        return {
+            'books': result[0],
+            'total_words': result[1],
+            'total_characters': result[2],
+            'total_pages': result[3],
+            'reading_minutes': round(result[4], 1)
+        }
+    
     def get_reading_progress(self, book_id):
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        c.execute("SELECT chapter, page FROM reading_progress WHERE book_id = ?", (book_id,))
-        result = c.fetchone()
-        conn.close()
+        pending = self.progress_buffer.get(book_id) if self.progress_buffer else None
+        if pending:
+            return pending[1:]
+        result = self.db.fetchone("SELECT chapter, page FROM reading_progress WHERE book_id = ?", (book_id,))
         return result if result else (0, 1)
     
+    def get_current_book_id(self):
+        # The most recently read book; unwritten updates are always the newest
+        book_id = self.progress_buffer.last_key() if self.progress_buffer else None
+        if book_id:
+            return book_id
+        result = self.db.fetchone("SELECT book_id FROM reading_progress ORDER BY rowid DESC LIMIT 1")
+        return result[0] if result else None
+    
     def save_progress(self, book_id, chapter, page):
-        if not isinstance(chapter, int) or chapter < 0:
-            raise ValueError("Invalid chapter number")
-        if not isinstance(page, int) or page < 1:
-            raise ValueError("Invalid page number")
+        self.save_progress_batch([(book_id, chapter, page)])
+    
+    def save_progress_batch(self, updates):
+        """Save (book_id, chapter, page) updates; the last one for a book wins"""
+        # Checked up front, a value SQLite rejects would otherwise fail a whole
+        # buffered batch
+        for book_id, chapter, page in updates:
+            if not isinstance(book_id, str):
+                raise ValueError("Invalid book id")
+            if not isinstance(chapter, int) or not 0 <= chapter <= SQLITE_MAX_INTEGER:
+                raise ValueError("Invalid chapter number")
+            if not isinstance(page, int) or not 1 <= page <= SQLITE_MAX_INTEGER:
+                raise ValueError("Invalid page number")
         
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        try:
-            c.execute("INSERT OR REPLACE INTO reading_progress VALUES (?, ?, ?)", 
-                     (book_id, chapter, page))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        if self.progress_buffer is None:
+            self.write_progress(updates)
+            return
+        for book_id, chapter, page in updates:
+            self.progress_buffer.put(book_id, (book_id, chapter, page))
+    
+    def write_progress(self, rows):
+        # INSERT OR REPLACE gives each row a new rowid, which orders /current_book
+        with self.db.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO reading_progress VALUES (?, ?, ?)", rows)
+    
+    def flush_progress(self):
+        if self.progress_buffer:
+            self.progress_buffer.flush()
+    
+    def discard_progress(self, book_id):
+        if self.progress_buffer:
+            self.progress_buffer.discard(book_id)
     
     def add_bookmark(self, book_id, chapter, page, chapter_title, bookmark_title, description):
         if not isinstance(chapter, int) or chapter < 0:
@@ -195,57 +1039,405 @@ class EPUBReader:
         if not bookmark_title or not chapter_title:
             raise ValueError("Invalid titles")
         
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        try:
-            c.execute("INSERT INTO bookmarks (book_id, chapter, page, chapter_title, bookmark_title, description) VALUES (?, ?, ?, ?, ?, ?)",
-                     (book_id, chapter, page, chapter_title, bookmark_title, description))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        self.db.execute("INSERT INTO bookmarks (book_id, chapter, page, chapter_title, bookmark_title, description) VALUES (?, ?, ?, ?, ?, ?)",
+                        (book_id, chapter, page, chapter_title, bookmark_title, description))
     
-    def get_bookmarks(self, book_id):
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        c.execute("SELECT id, chapter, page, chapter_title, bookmark_title, description, created_at FROM bookmarks WHERE book_id = ? ORDER BY created_at DESC", (book_id,))
-        result = c.fetchall()
-        conn.close()
-        return result
+    def get_bookmarks(self, book_id=None, sort='created', query=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of bookmarks, optionally for a single book and matching
+        query in the titles or description. Returns (bookmarks, next_cursor)."""
+        keys, descending = BOOKMARK_SORTS[sort]
+        where, params = [], []
+        if book_id:
+            where.append("b.book_id = ?")
+            params.append(book_id)
+        if query:
+            where.append("(b.bookmark_title LIKE ? ESCAPE '\\' OR b.chapter_title LIKE ? ESCAPE '\\' "
+                         "OR b.description LIKE ? ESCAPE '\\')")
+            params += [like_pattern(query)] * 3
+        rows, next_cursor = keyset_query(
+            self.db, """b.id, b.chapter, b.page, b.chapter_title, b.bookmark_title, b.description,
+                         b.created_at, bk.title, bk.author, b.book_id""",
+            "bookmarks b JOIN books bk ON b.book_id = bk.id", where, params, keys, descending, cursor, limit)
+        return [{
+            'id': row[0], 'chapter': row[1], 'page': row[2], 'chapter_title': row[3],
+            'bookmark_title': row[4], 'description': row[5], 'created_at': row[6],
+            'book_title': row[7], 'author': row[8], 'book_id': row[9]
+        } for row in rows], next_cursor
     
-    def get_all_bookmarks(self):
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        c.execute("""SELECT b.id, b.chapter, b.page, b.chapter_title, b.bookmark_title, b.description, 
-                            b.created_at, bk.title as book_title, bk.author, b.book_id
-                     FROM bookmarks b 
-                     JOIN books bk ON b.book_id = bk.id 
-                     ORDER BY b.created_at DESC""")
-        result = c.fetchall()
-        conn.close()
-        return result
+    def get_books(self, sort='title', query=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of the library, optionally matching query in the title or
+        author. Returns (books, next_cursor)."""
+        keys, descending = BOOK_SORTS[sort]
+        where, params = [], []
+        if query:
+            where.append("(title LIKE ? ESCAPE '\\' OR author LIKE ? ESCAPE '\\')")
+            params += [like_pattern(query)] * 2
+        rows, next_cursor = keyset_query(self.db, "id, title, author, chapters", "books", where, params,
+                                         keys, descending, cursor, limit)
+        return [{'id': row[0], 'title': row[1], 'author': row[2], 'chapters': row[3]} for row in rows], next_cursor
     
     def delete_bookmark(self, bookmark_id):
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        c.execute("DELETE FROM bookmarks WHERE id = ?", (bookmark_id,))
-        conn.commit()
-        conn.close()
+        self.db.execute("DELETE FROM bookmarks WHERE id = ?", (bookmark_id,))
+    
+    def delete_book(self, book_id):
+        self.discard_progress(book_id)
+        with self.db.transaction() as c:
+            stats = c.execute("SELECT words, characters, pages, reading_minutes FROM book_stats WHERE book_id = ?",
+                              (book_id,)).fetchone()
+            if stats:
+                self.add_library_stats(c, -1, *(-value for value in stats))
+            c.execute("DELETE FROM books WHERE id = ?", (book_id,))
+            for table in BOOK_CONTENT_TABLES + BOOK_USER_TABLES:
+                c.execute(f"DELETE FROM {table} WHERE book_id = ?", (book_id,))
+            self.purge_images(c)
+            self.bump_library_version(c)
+    
+    def purge_images(self, c):
+        # Image blobs are shared between books, so they go once nothing refers to them
+        c.execute("DELETE FROM image_variants WHERE hash NOT IN (SELECT hash FROM book_images)")
+        variants = c.rowcount
+        c.execute("""DELETE FROM image_blobs WHERE hash NOT IN (SELECT hash FROM book_images)
+                     AND hash NOT IN (SELECT variant_hash FROM image_variants)""")
+        return {'image_variants': variants, 'image_blobs': c.rowcount}
+    
+    def purge_orphans(self):
+        """Delete rows whose book is gone, including leftovers of interrupted
+        ingests, and finished jobs older than JOB_RETENTION_DAYS. Returns the
+        number of rows removed per table."""
+        purged = {}
+        with self.db.transaction() as c:
+            c.execute("DELETE FROM pending_books WHERE started_at < datetime('now', ?)",
+                      (f'-{STALE_INGEST_HOURS} hours',))
+            purged['pending_books'] = c.rowcount
+            for table in BOOK_CONTENT_TABLES + BOOK_USER_TABLES:
+                c.execute(f"""DELETE FROM {table} WHERE book_id NOT IN (SELECT id FROM books)
+                               AND book_id NOT IN (SELECT book_id FROM pending_books)""")
+                purged[table] = c.rowcount
+            purged.update(self.purge_images(c))
+            c.execute("""DELETE FROM ingest_jobs WHERE status IN ('done', 'error')
+                         AND created_at < datetime('now', ?)""", (f'-{JOB_RETENTION_DAYS} days',))
+            purged['ingest_jobs'] = c.rowcount
+        return purged
+    
+    def run_maintenance(self, full_vacuum=False):
+        """Purge orphans, return free pages to the filesystem and refresh the
+        query planner statistics.
+
+        Incremental vacuum only holds the write lock briefly, so it runs while
+        the app is serving. A database created before auto_vacuum was enabled
+        needs one full VACUUM (full_vacuum=True) to switch over, which blocks
+        writers for its duration; until then freed pages are only reused.
+        """
+        start = time.perf_counter()
+        size_before = self.db.file_size()
+        self.flush_progress()
+        purged = self.purge_orphans()
+        with self.db.transaction() as c:
+            # Merges the index segments that deleted chapters leave behind
+            c.execute("INSERT INTO chapters_fts (chapters_fts) VALUES ('optimize')")
+            # Corrects any drift in the running totals, e.g. from purged leftovers
+            self.refresh_library_stats(c)
+        
+        conn = self.db.connect()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_bytes = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        if full_vacuum:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            vacuum = 'full'
+        elif conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # execute() would only step it once, freeing a single page
+            conn.executescript("PRAGMA incremental_vacuum")
+            vacuum = 'incremental'
+        else:
+            vacuum = 'skipped'
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size_after = self.db.file_size()
+        return {
+            'purged': purged,
+            'vacuum': vacuum,
+            'free_bytes': free_bytes,
+            'bytes_before': size_before,
+            'bytes_after': size_after,
+            'reclaimed_bytes': max(0, size_before - size_after),
+            'seconds': time.perf_counter() - start
+        }
+    
+    def replace_book(self, old_id, new_id):
+        """Move reading progress and bookmarks to a re-imported copy, then delete the old book"""
+        with self.db.transaction() as c:
+            c.execute("UPDATE OR IGNORE reading_progress SET book_id = ? WHERE book_id = ?", (new_id, old_id))
+            c.execute("UPDATE bookmarks SET book_id = ? WHERE book_id = ?", (new_id, old_id))
+        self.delete_book(old_id)
+
+reader = EPUBReader(app.config['DATABASE'], app.config['HTML_PARSER'], app.config['PROGRESS_FLUSH_SECONDS'])
+atexit.register(reader.flush_progress)
+response_cache = LRUCache(app.config['CACHE_MAX_BYTES'])
+
+metrics = Metrics()
+metrics.counter('reader_requests_total', 'HTTP requests by route, method and status')
+metrics.histogram('reader_request_duration_seconds', 'Time spent in the view, excluding streamed bodies', DURATION_BUCKETS)
+metrics.histogram('reader_response_size_bytes', 'Response body size where known', SIZE_BUCKETS)
+metrics.histogram('reader_db_query_duration_seconds', 'SQLite time by statement and phase', QUERY_BUCKETS)
+metrics.histogram('reader_ingest_stage_duration_seconds', 'EPUB ingest time by stage', STAGE_BUCKETS)
+metrics.counter('reader_ingest_jobs_total', 'Finished ingest jobs by outcome')
+metrics.gauge('reader_cache', 'Response cache statistics')
+
+def observe_query(statement, phase, seconds):
+    metrics.observe('reader_db_query_duration_seconds', seconds, statement=statement, phase=phase)
+    if has_request_context():
+        g.db_seconds = g.get('db_seconds', 0) + seconds
+        g.db_queries = g.get('db_queries', 0) + (phase == 'execute')
 
-reader = EPUBReader()
+reader.db.observer = observe_query
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    # The URL rule keeps book ids and queries out of the label values
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('reader_requests_total', route=route, method=request.method, status=response.status_code)
+    metrics.observe('reader_request_duration_seconds', elapsed, route=route, method=request.method)
+    if response.content_length is not None:
+        metrics.observe('reader_response_size_bytes', response.content_length, route=route)
+    if app.config['SLOW_REQUEST_MS'] and elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning('Slow request: %s %s %d in %.1fms (%d queries, %.1fms in SQLite, %s bytes)',
+                           request.method, request.full_path.rstrip('?'), response.status_code, elapsed * 1000,
+                           g.get('db_queries', 0), g.get('db_seconds', 0) * 1000, response.content_length)
+    return response
+
+def cached_json(key, build):
+    # build() returns the payload, or None for a miss that should not be cached
+    data = response_cache.get(key)
+    if data is None:
+        payload = build()
+        if payload is None:
+            return None
+        data = app.json.dumps(payload).encode('utf-8')
+        response_cache.set(key, data)
+    return data
+
+def json_response(data, compress=False, cache_key=None):
+    response = Response(data, mimetype='application/json')
+    # Bundles carry whole chapters, so they are gzipped like /chapter_html.
+    # cache_key, which must identify data, keeps the gzipped body in the
+    # response cache so it is compressed once rather than on every request
+    if compress:
+        response.vary.add('Accept-Encoding')
+        if request.accept_encodings['gzip'] and len(data) > 1024:
+            body = response_cache.get(cache_key) if cache_key else None
+            if body is None:
+                body = gzip.compress(data, compresslevel=6, mtime=0)
+                if cache_key:
+                    response_cache.set(cache_key, body)
+            response.set_data(body)
+            response.content_encoding = 'gzip'
+    return response
+
+def chapter_json(book_id, chapter_num):
+    return cached_json((book_id, 'chapter', chapter_num), lambda: reader.get_chapter(book_id, chapter_num))
+
+def chapter_range_json(book_id, chapter_num, ahead):
+    # Chapters chapter_num - 1 through chapter_num + ahead, as a JSON array
+    chapters = []
+    for n in range(max(0, chapter_num - 1), chapter_num + min(max(ahead, 0), MAX_PREFETCH_CHAPTERS) + 1):
+        data = chapter_json(book_id, n)
+        if data is None:
+            if n >= chapter_num:
+                break
+            continue
+        chapters.append(data)
+    return b'[' + b','.join(chapters) + b']'
+
+def page_json(book_id, chapter_num, page_num):
+    return cached_json((book_id, 'page', chapter_num, page_num),
+                       lambda: reader.get_page(book_id, chapter_num, page_num))
+
+def page_range_json(book_id, chapter_num, page_num, count):
+    pages = []
+    for n in range(max(1, page_num), max(1, page_num) + min(max(count, 1), MAX_PAGES_PER_REQUEST)):
+        data = page_json(book_id, chapter_num, n)
+        if data is None:
+            break
+        pages.append(data)
+    return b'[' + b','.join(pages) + b']'
+
+def warm_up(book_count=None):
+    """Load the parser, libmagic and Pillow plugins, and fill the response
+    cache for the most recently read books. Run in the gunicorn master before
+    workers are forked so each starts with the result."""
+    start = time.perf_counter()
+    reader.parser.text(reader.parser.parse('<p>warm up</p>'))
+    magic.from_buffer(b'PK\x03\x04', mime=True)
+    if Image is not None:
+        Image.init()
+    
+    if book_count is None:
+        book_count = app.config['WARM_UP_BOOKS']
+    rows = reader.db.fetchall("SELECT book_id FROM reading_progress ORDER BY rowid DESC LIMIT ?", (book_count,))
+    for (book_id,) in rows:
+        # What /book_bundle?ahead=1 serves from the cache when the book is opened
+        toc_json(book_id)
+        chapter_mapping_json(book_id)
+        page_map_json(book_id)
+        book_stats_json(book_id)
+        chapter, page = reader.get_reading_progress(book_id)
+        page_range_json(book_id, chapter, page, 2)
+    return {'books': len(rows), 'cache_bytes': response_cache.stats()['bytes'],
+            'seconds': time.perf_counter() - start}
+
+def toc_json(book_id):
+    return cached_json((book_id, 'toc'), lambda: reader.get_toc(book_id))
+
+def chapter_mapping_json(book_id):
+    return cached_json((book_id, 'chapter_mapping'), lambda: reader.get_chapter_mapping(book_id))
+
+def page_map_json(book_id):
+    def build():
+        stats = reader.get_book_stats(book_id)
+        page_map = [{key: chapter[key] for key in ('chapter', 'total_pages', 'start_page')}
+                    for chapter in stats['chapters']]
+        return {'chapters': page_map, 'total_pages': stats['total_pages']}
+    return cached_json((book_id, 'page_map'), build)
+
+def book_stats_json(book_id):
+    return cached_json((book_id, 'book_stats'), lambda: reader.get_book_stats(book_id))
+
+def conditional_response(etag, view, *args, **kwargs):
+    # Answers If-None-Match with 304 before doing any of the view's work
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def book_etag(include_progress=False, vary_encoding=False):
+    # Book content never changes after ingest, so the book's version stamp
+    # identifies every read-only response derived from it
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(book_id, **kwargs):
+            version = reader.get_book_version(book_id)
+            if version is None:
+                # Checked before the view: another worker may have deleted the
+                # book, leaving responses for it in this worker's cache
+                return jsonify({'error': 'Book not found'}), 404
+            etag = version
+            if include_progress:
+                etag += '-%d-%d' % tuple(reader.get_reading_progress(book_id))
+            if vary_encoding and request.accept_encodings['gzip']:
+                etag += '-gzip'
+            response = conditional_response(etag, view, book_id, **kwargs)
+            if vary_encoding:
+                response.vary.add('Accept-Encoding')
+            return response
+        return wrapper
+    return decorator
+
+ingest_pool = None
+ingest_pool_lock = threading.Lock()
+
+def get_ingest_pool():
+    global ingest_pool
+    with ingest_pool_lock:
+        if ingest_pool is None:
+            # Forking this multi-threaded process could copy a held lock or the
+            # parent's SQLite connection into the worker, so workers start clean
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            ingest_pool = ProcessPoolExecutor(max_workers=app.config['INGEST_WORKERS'],
+                                              mp_context=multiprocessing.get_context(method),
+                                              initializer=init_ingest_worker)
+        return ingest_pool
+
+def init_ingest_worker():
+    # Query metrics of a pool worker would never be scraped
+    reader.db.observer = None
+
+def submit_ingest(*args):
+    # A worker that dies abruptly (e.g. OOM-killed on a huge EPUB) breaks the
+    # whole pool, so it is replaced and the job submitted once more
+    global ingest_pool
+    pool = get_ingest_pool()
+    try:
+        return pool.submit(run_ingest_job, *args)
+    except BrokenProcessPool:
+        with ingest_pool_lock:
+            if ingest_pool is pool:
+                ingest_pool = None
+        pool.shutdown(wait=False)
+        return get_ingest_pool().submit(run_ingest_job, *args)
+
+def save_upload(stream, file_path, chunk_size=1024 * 1024):
+    # Hashes the upload in the same pass that copies it to disk
+    sha = hashlib.sha256()
+    size = 0
+    with open(file_path, 'wb') as f:
+        while chunk := stream.read(chunk_size):
+            sha.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+def run_ingest_job(job_id, file_path, streaming=True, source=None, replaces=None):
+    # Runs in a pool worker process; progress is written to ingest_jobs so any
+    # web worker can report it
+    last = {}
+    
+    def progress(stage, done, total):
+        # Only write on stage changes and every ~5% within a stage
+        step = max(1, total // 20)
+        if stage != last.get('stage') or done == total or done - last.get('done', 0) >= step:
+            reader.update_job(job_id, status='running', stage=stage, done=done, total=total)
+            last.update(stage=stage, done=done)
+    
+    try:
+        parse = reader.stream_epub if streaming else reader.parse_epub
+        book_data = parse(file_path, progress, source)
+        if replaces:
+            reader.replace_book(replaces, book_data['id'])
+        reader.update_job(job_id, status='done', book_id=book_data['id'],
+                          peak_memory_kb=book_data['peak_memory_kb'])
+        return book_data
+    except Exception as e:
+        reader.update_job(job_id, status='error', error=f'Failed to parse EPUB: {str(e)}')
+        raise
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def ingest_job_finished(job_id, future, file_path, replaces=None):
+    # Covers failures that never reached run_ingest_job, such as a broken pool
+    error = future.exception()
+    if error is not None and reader.get_job(job_id)['status'] != 'error':
+        reader.update_job(job_id, status='error', error=f'Failed to parse EPUB: {str(error)}')
+    if error is not None and os.path.exists(file_path):
+        os.remove(file_path)
+    metrics.inc('reader_ingest_jobs_total', status='error' if error else 'done')
+    if error is None:
+        book_data = future.result()
+        response_cache.invalidate_book(book_data['id'])
+        if replaces:
+            # Anything read in the old copy since the upload is dropped
+            reader.discard_progress(replaces)
+            response_cache.invalidate_book(replaces)
+        for stage, seconds in book_data['stage_seconds'].items():
+            metrics.observe('reader_ingest_stage_duration_seconds', seconds, stage=stage)
 
 @app.route('/current_book')
 def get_current_book():
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT book_id FROM reading_progress ORDER BY rowid DESC LIMIT 1")
-    result = c.fetchone()
-    conn.close()
-    
-    if result:
-        return load_book(result[0])
+    book_id = reader.get_current_book_id()
+    
+    if book_id:
+        return load_book(book_id)
     return jsonify({'error': 'No book loaded'})
 
 @app.route('/')
@@ -260,14 +1452,21 @@ def manage():
 def bookmarks_page():
     return render_template('bookmarks.html')
 
+def listing_response(get_items, sorts, default_sort, **filters):
+    # Shared ?sort=, ?q=, ?cursor= and ?limit= handling for the paginated listings
+    sort = request.args.get('sort', default_sort)
+    if sort not in sorts:
+        return jsonify({'error': f"Invalid sort, expected one of {', '.join(sorts)}"}), 400
+    try:
+        items, next_cursor = get_items(sort=sort, query=request.args.get('q'), cursor=request.args.get('cursor'),
+                                       limit=request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), **filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
 @app.route('/all_bookmarks')
 def get_all_bookmarks():
-    bookmarks = reader.get_all_bookmarks()
-    return jsonify([{
-        'id': row[0], 'chapter': row[1], 'page': row[2], 'chapter_title': row[3],
-        'bookmark_title': row[4], 'description': row[5], 'created_at': row[6],
-        'book_title': row[7], 'author': row[8], 'book_id': row[9]
-    } for row in bookmarks])
+    return listing_response(reader.get_bookmarks, BOOKMARK_SORTS, 'created', book_id=request.args.get('book_id'))
 
 @app.route('/delete_bookmark/<int:bookmark_id>', methods=['DELETE'])
 def delete_bookmark(bookmark_id):
@@ -276,33 +1475,41 @@ def delete_bookmark(bookmark_id):
 
 @app.route('/books')
 def get_books():
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT id, title, author, chapters FROM books")
-    books = [{'id': row[0], 'title': row[1], 'author': row[2], 'chapters': row[3]} for row in c.fetchall()]
-    conn.close()
-    return jsonify(books)
+    return conditional_response(reader.get_library_version(), list_books)
+
+def list_books():
+    return listing_response(reader.get_books, BOOK_SORTS, 'title')
 
 @app.route('/load_book/<book_id>')
+@book_etag(include_progress=True)
 def load_book(book_id):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT title, author, chapters FROM books WHERE id = ?", (book_id,))
-    result = c.fetchone()
-    conn.close()
-    
-    if result:
-        progress = reader.get_reading_progress(book_id)
-        return jsonify({
-            'id': book_id,
-            'title': result[0],
-            'author': result[1],
-            'chapter_count': result[2],
-            'last_chapter': progress[0],
-            'last_page': progress[1]
-        })
+    book = reader.get_book(book_id)
+    if book:
+        return jsonify(book)
     return jsonify({'error': 'Book not found'}), 404
 
+@app.route('/book_bundle/<book_id>')
+@book_etag(include_progress=True, vary_encoding=True)
+def get_book_bundle(book_id):
+    # Everything needed to open a book in one response; ?ahead=k also includes
+    # the page at the reading position and the k pages after it
+    book = reader.get_book(book_id)
+    if not book:
+        return jsonify({'error': 'Book not found'}), 404
+    
+    parts = [
+        b'"book":' + app.json.dumps(book).encode('utf-8'),
+        b'"toc":' + toc_json(book_id),
+        b'"chapter_mapping":' + chapter_mapping_json(book_id),
+        b'"page_map":' + page_map_json(book_id),
+        b'"stats":' + book_stats_json(book_id),
+    ]
+    ahead = request.args.get('ahead', type=int)
+    if ahead is not None:
+        parts.append(b'"pages":' + page_range_json(book_id, book['last_chapter'], book['last_page'], ahead + 1))
+    return json_response(b'{' + b','.join(parts) + b'}', compress=True,
+                         cache_key=(book_id, 'book_bundle_gzip', book['last_chapter'], book['last_page'], ahead))
+
 @app.route('/upload', methods=['POST'])
 def upload_epub():
     if 'file' not in request.files:
@@ -324,48 +1531,88 @@ def upload_epub():
         if not re.match(r'^[a-zA-Z0-9_.-]+\.epub$', file.filename):
             return jsonify({'error': 'Invalid filename.'}), 400
         
-        file_path = f"uploads/{os.path.basename(file.filename)}"
+        file_path = f"uploads/{uuid.uuid4()}_{os.path.basename(file.filename)}"
         os.makedirs('uploads', exist_ok=True)
-        file.save(file_path)
+        content_hash, size = save_upload(file.stream, file_path)
         
-        try:
-            book_data = reader.parse_epub(file_path)
+        # The same file is only parsed once: an upload of a file still being
+        # parsed follows that job. The job is claimed before looking for the
+        # book, which an earlier job writes before it is marked done
+        job_id, created = reader.create_job(file.filename, content_hash)
+        if not created:
+            os.remove(file_path)
+            return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+        
+        # force=1 re-imports it in place of the existing copy, keeping its
+        # reading progress and bookmarks
+        existing_id = reader.find_book_by_hash(content_hash)
+        if existing_id and request.values.get('force') not in ('1', 'true'):
+            reader.delete_job(job_id)
             os.remove(file_path)
-            return jsonify(book_data)
+            book = reader.get_book(existing_id)
+            return jsonify({'status': 'exists', 'book': {
+                'id': existing_id, 'title': book['title'], 'author': book['author'],
+                'chapter_count': book['chapter_count']
+            }})
+        
+        if existing_id:
+            # The worker moves progress over from the database
+            reader.flush_progress()
+        try:
+            future = submit_ingest(job_id, file_path, app.config['STREAMING_INGEST'],
+                                   (content_hash, file.filename, size), existing_id)
         except Exception as e:
-            # Cleanup on failure
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return jsonify({'error': f'Failed to parse EPUB: {str(e)}'}), 500
-        finally:
-            # Ensure cleanup
             if os.path.exists(file_path):
                 os.remove(file_path)
+            reader.update_job(job_id, status='error', error=f'Failed to queue EPUB: {str(e)}')
+            return jsonify({'error': f'Failed to queue EPUB: {str(e)}'}), 500
+        future.add_done_callback(lambda f: ingest_job_finished(job_id, f, file_path, existing_id))
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
     
     return jsonify({'error': 'Invalid file format'}), 400
 
+@app.route('/upload_status/<job_id>')
+def upload_status(job_id):
+    job = reader.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 @app.route('/chapter/<book_id>/<int:chapter_num>')
+@book_etag()
 def get_chapter(book_id, chapter_num):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT title, content, word_count FROM chapters WHERE book_id = ? AND chapter_num = ?",
-             (book_id, chapter_num))
-    result = c.fetchone()
-    conn.close()
-    
-    if not result:
-        return jsonify({'error': 'Chapter not found'})
-    
-    title, content, word_count = result
-    words_per_page = 250
-    total_pages = max(1, (word_count + words_per_page - 1) // words_per_page)
+    data = chapter_json(book_id, chapter_num)
+    return json_response(data) if data else jsonify({'error': 'Chapter not found'})
+
+@app.route('/chapters/<book_id>/<int:chapter_num>')
+@book_etag(vary_encoding=True)
+def get_chapter_range(book_id, chapter_num):
+    # The previous chapter, this one and up to ?ahead= following ones, for prefetching
+    ahead = request.args.get('ahead', 1, type=int)
+    return json_response(b'{"chapters":' + chapter_range_json(book_id, chapter_num, ahead) + b'}', compress=True,
+                         cache_key=(book_id, 'chapters_gzip', chapter_num, ahead))
+
+@app.route('/chapter_html/<book_id>/<int:chapter_num>')
+@book_etag(vary_encoding=True)
+def get_chapter_html(book_id, chapter_num):
+    content = response_cache.get((book_id, 'chapter_html', chapter_num))
+    if content is None:
+        result = reader.db.fetchone("SELECT content FROM chapters WHERE book_id = ? AND chapter_num = ?",
+                                    (book_id, chapter_num))
+        if not result:
+            return Response('Chapter not found', status=404, mimetype='text/plain')
+        content = result[0]
+        response_cache.set((book_id, 'chapter_html', chapter_num), content)
     
-    return jsonify({
-        'title': title,
-        'content': content,
-        'total_pages': total_pages,
-        'word_count': word_count
-    })
+    # The stored gzip body is sent as-is to clients that accept it
+    response = Response(mimetype='text/html')
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip']:
+        response.set_data(content)
+        response.content_encoding = 'gzip'
+    else:
+        response.set_data(decompress_chapter(content))
+    return response
 
 @app.route('/progress', methods=['POST'])
 def save_progress():
@@ -390,6 +1637,23 @@ def save_progress():
     except Exception as e:
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/progress/batch', methods=['POST'])
+def save_progress_batch():
+    try:
+        data = request.get_json()
+        updates = data.get('updates') if isinstance(data, dict) else None
+        if not isinstance(updates, list) or not all(
+                isinstance(update, dict) and 'book_id' in update and 'chapter' in update and 'page' in update
+                for update in updates):
+            return jsonify({'error': 'Invalid data'}), 400
+        
+        reader.save_progress_batch([(update['book_id'], update['chapter'], update['page']) for update in updates])
+        return jsonify({'success': True, 'saved': len(updates)})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/bookmark', methods=['POST'])
 def add_bookmark():
     try:
@@ -416,127 +1680,145 @@ def add_bookmark():
 
 @app.route('/bookmarks/<book_id>')
 def get_bookmarks(book_id):
-    bookmarks = reader.get_bookmarks(book_id)
-    return jsonify(bookmarks)
+    return listing_response(reader.get_bookmarks, BOOKMARK_SORTS, 'created', book_id=book_id)
+
+@app.route('/pages/<book_id>/<int:chapter_num>/<int:page_num>')
+@book_etag(vary_encoding=True)
+def get_pages(book_id, chapter_num, page_num):
+    # ?count=k serves k pages from page_num on; ?anchor=id starts at the page holding that element
+    anchor = request.args.get('anchor')
+    if anchor:
+        page_num = reader.find_anchor_page(book_id, chapter_num, anchor) or page_num
+    count = request.args.get('count', 1, type=int)
+    pages = page_range_json(book_id, chapter_num, page_num, count)
+    if pages == b'[]':
+        return jsonify({'error': 'Page not found'}), 404
+    return json_response(b'{"chapter":%d,"pages":%s}' % (chapter_num, pages), compress=True,
+                         cache_key=(book_id, 'pages_gzip', chapter_num, page_num, count))
 
 @app.route('/toc/<book_id>')
+@book_etag()
 def get_toc(book_id):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT chapter_num, title FROM chapters WHERE book_id = ? ORDER BY chapter_num",
-             (book_id,))
-    chapters = [{'index': row[0], 'title': row[1]} for row in c.fetchall()]
-    conn.close()
-    
-    return jsonify(chapters)
+    return json_response(toc_json(book_id))
 
 @app.route('/chapter_mapping/<book_id>')
+@book_etag()
 def get_chapter_mapping(book_id):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT href, chapter_num FROM chapter_mapping WHERE book_id = ?", (book_id,))
-    mapping = {row[0]: row[1] for row in c.fetchall()}
-    
-    # If no mapping exists, create a simple numeric mapping
-    if not mapping:
-        c.execute("SELECT chapter_num FROM chapters WHERE book_id = ? ORDER BY chapter_num", (book_id,))
-        chapters = c.fetchall()
-        for i, (chapter_num,) in enumerate(chapters):
-            # Create simple mapping: ch01.xhtml -> 0, ch02.xhtml -> 1, etc.
-            filename = f"ch{i+1:02d}.xhtml"
-            mapping[filename] = chapter_num
-            # Also try common variations
-            mapping[f"chapter{i+1}.xhtml"] = chapter_num
-            mapping[f"ch{i+1}.xhtml"] = chapter_num
-            mapping[f"chapter_{i+1}.xhtml"] = chapter_num
-    
-    conn.close()
-    return jsonify(mapping)
+    return json_response(chapter_mapping_json(book_id))
 
 @app.route('/delete_book/<book_id>', methods=['DELETE'])
 def delete_book(book_id):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("DELETE FROM books WHERE id = ?", (book_id,))
-    c.execute("DELETE FROM chapters WHERE book_id = ?", (book_id,))
-    c.execute("DELETE FROM reading_progress WHERE book_id = ?", (book_id,))
-    c.execute("DELETE FROM bookmarks WHERE book_id = ?", (book_id,))
-    conn.commit()
-    conn.close()
+    reader.delete_book(book_id)
+    response_cache.invalidate_book(book_id)
     return jsonify({'success': True})
 
+@app.route('/admin/maintenance', methods=['POST'])
+def run_maintenance():
+    # Only the incremental vacuum; the full VACUUM blocks writes, so it is left
+    # to maintenance.py --full
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(reader.run_maintenance())
+
 @app.route('/search/<book_id>/<query>')
 def search_book(book_id, query):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT chapter_num, title, content FROM chapters WHERE book_id = ? ORDER BY chapter_num", (book_id,))
-    chapters = c.fetchall()
-    conn.close()
-    
-    results = []
-    for chapter_num, title, content in chapters:
-        # Remove HTML tags for search
-        from bs4 import BeautifulSoup
-        text = BeautifulSoup(content, 'html.parser').get_text()
-        
-        if query.lower() in text.lower():
-            # Find context around matches
-            words = text.split()
-            for i, word in enumerate(words):
-                if query.lower() in word.lower():
-                    start = max(0, i - 10)
-                    end = min(len(words), i + 10)
-                    context = ' '.join(words[start:end])
-                    results.append({
-                        'chapter': chapter_num,
-                        'title': title,
-                        'context': context
-                    })
-                    break
-    
-    return jsonify(results)
+    limit = request.args.get('limit', 200, type=int)
+    return jsonify(reader.search_book(book_id, query, limit))
+
+@app.route('/search_all/<query>')
+def search_library(query):
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(reader.search_library(query, limit))
+
+@app.route('/page_map/<book_id>')
+@book_etag()
+def get_page_map(book_id):
+    return json_response(page_map_json(book_id))
 
 @app.route('/book_stats/<book_id>')
+@book_etag()
 def get_book_stats(book_id):
-    conn = sqlite3.connect('reader.db')
-    c = conn.cursor()
-    c.execute("SELECT SUM(word_count) FROM chapters WHERE book_id = ?", (book_id,))
-    total_words = c.fetchone()[0] or 0
-    conn.close()
-    
-    words_per_page = 250
-    total_book_pages = max(1, (total_words + words_per_page - 1) // words_per_page)
-    
-    return jsonify({'total_pages': total_book_pages, 'total_words': total_words})
+    return json_response(book_stats_json(book_id))
+
+@app.route('/library_stats')
+def get_library_stats():
+    # Maintenance can correct the totals without a library change, so the
+    # ETag comes from the totals themselves; reading them is one row anyway
+    stats = reader.get_library_stats()
+    etag = hashlib.sha1(app.json.dumps(stats).encode('utf-8')).hexdigest()[:16]
+    return conditional_response(etag, jsonify, stats)
+
+
+@app.route('/cache_stats')
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics')
+def get_metrics():
+    for name, value in response_cache.stats().items():
+        metrics.set('reader_cache', value, stat=name)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/image/<book_id>/<filename>')
 def get_image(book_id, filename):
-    from flask import Response
-    try:
-        # Sanitize filename
-        sanitized_filename = re.sub(r'[^a-zA-Z0-9_.]', '_', filename)
-        conn = sqlite3.connect('reader.db')
-        c = conn.cursor()
-        c.execute("SELECT data FROM images WHERE book_id = ? AND filename = ?", (book_id, sanitized_filename))
-        result = c.fetchone()
-        conn.close()
-        
-        if result:
-            # Detect image type from data
-            data = result[0]
-            if data.startswith(b'\x89PNG'):
-                mimetype = 'image/png'
-            elif data.startswith(b'\xff\xd8'):
-                mimetype = 'image/jpeg'
-            elif data.startswith(b'GIF'):
-                mimetype = 'image/gif'
-            else:
-                mimetype = 'image/jpeg'
-            return Response(data, mimetype=mimetype)
+    # Sanitize filename
+    sanitized_filename = re.sub(r'[^a-zA-Z0-9_.]', '_', filename)
+    result = None
+    
+    # ?w= selects a downscaled variant from the srcset, falling back to the original
+    width = request.args.get('w', type=int)
+    if width:
+        result = reader.db.fetchone("""SELECT ib.rowid, ib.hash, ib.media_type, ib.size
+                                       FROM book_images bi
+                                       JOIN image_variants iv ON iv.hash = bi.hash
+                                       JOIN image_blobs ib ON ib.hash = iv.variant_hash
+                                       WHERE bi.book_id = ? AND bi.filename = ? AND iv.width = ?""",
+                                    (book_id, sanitized_filename, width))
+    if not result:
+        result = reader.db.fetchone("""SELECT ib.rowid, ib.hash, ib.media_type, ib.size
+                                       FROM book_images bi
+                                       JOIN image_blobs ib ON ib.hash = bi.hash
+                                       WHERE bi.book_id = ? AND bi.filename = ?""", (book_id, sanitized_filename))
+    if not result:
         return Response('', status=404)
-    except Exception as e:
-        return Response('', status=500)
+    
+    rowid, image_hash, media_type, size = result
+    
+    # Blobs are keyed by content hash, so a given URL never changes
+    response = Response(mimetype=media_type)
+    response.set_etag(image_hash)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Accept-Ranges'] = 'bytes'
+    if media_type == 'image/svg+xml':
+        response.headers['Content-Security-Policy'] = "script-src 'none'"
+    
+    if request.if_none_match.contains(image_hash):
+        response.status_code = 304
+        return response
+    
+    start, length = 0, size
+    # Only single ranges are served; a multi-range request gets the whole
+    # image, which a server may always send instead
+    if request.range and len(request.range.ranges) == 1 and request.if_range.etag in (None, image_hash):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        start, end = byte_range
+        length = end - start
+        response.status_code = 206
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    
+    response.response = reader.db.iter_blob('image_blobs', 'data', rowid, start, length)
+    response.content_length = length
+    response.direct_passthrough = True
+    return response
 
 
 if __name__ == '__main__':
+    reader.fail_unfinished_jobs()
     app.run(debug=True)
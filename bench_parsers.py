@@ -0,0 +1,102 @@
+"""Compare HTML parser backends on chapter processing.
+
+Usage: python bench_parsers.py BOOK.epub [BOOK.epub ...] [--repeat N]
+
+epub_generator.py can produce a synthetic corpus to run it on.
+
+Runs every spine document of each EPUB through EPUBReader.prepare_chapter
+with each installed backend, reports throughput, and checks that titles,
+word counts, image attributes and the rewritten markup match html.parser.
+Markup is compared as a DOM, ignoring attribute order and whitespace-only text.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+import ebooklib
+from ebooklib import epub
+
+from bs4 import BeautifulSoup
+
+from html_parsers import available_parsers, decode_markup
+
+IMAGE_ATTRS = ('src', 'onerror', 'style', 'srcset', 'sizes')
+
+
+def load_chapters(paths):
+    chapters = []
+    for path in paths:
+        book = epub.read_epub(path, options={'ignore_ncx': True})
+        for item_id, linear in book.spine:
+            item = book.get_item_with_id(item_id)
+            if item and item.get_type() == ebooklib.ITEM_DOCUMENT:
+                chapters.append((item.get_name(), item.get_content()))
+    return chapters
+
+
+def normalize(html):
+    # bs4 sorts attributes on output, so re-parsing with it compares the DOM
+    # regardless of attribute order; whitespace-only text is not compared
+    soup = BeautifulSoup(decode_markup(html), 'html.parser')
+    images = [tuple(img.get(name) for name in IMAGE_ATTRS) for img in soup.find_all('img')]
+    return re.sub(r'>\s+<', '><', str(soup)).strip(), images
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument('epubs', nargs='+')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    chapters = load_chapters(args.epubs)
+    total_bytes = sum(len(content) for href, content in chapters)
+    print(f'{len(chapters)} chapters, {total_bytes / 1e6:.1f} MB of XHTML from {len(args.epubs)} EPUBs')
+
+    srcsets = {}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # Importing app opens its database, keep it out of the working directory
+        os.environ['READER_DB'] = os.path.join(tmp, 'reader.db')
+        import app as reader_app
+        for name in available_parsers():
+            reader = reader_app.EPUBReader(os.path.join(tmp, f'{name}.db'), parser=name)
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                output = [reader.prepare_chapter('bench', href, reader.parser.parse(content), srcsets)
+                          for href, content in chapters]
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = (best, output)
+
+    reference = results['html.parser'][1]
+    print(f'{"backend":<12} {"seconds":>8} {"chapters/s":>11} {"MB/s":>7} {"speedup":>8}  matches html.parser')
+    for name, (elapsed, output) in results.items():
+        mismatches = []
+        for (href, content), ours, theirs in zip(chapters, output, reference):
+            if (ours is None) != (theirs is None):
+                mismatches.append(f'{href}: empty')
+                continue
+            if ours is None:
+                continue
+            for field in ('title', 'word_count'):
+                if ours[field] != theirs[field]:
+                    mismatches.append(f'{href}: {field} {ours[field]!r} != {theirs[field]!r}')
+            ours_html, ours_images = normalize(reader_app.decompress_chapter(ours['content']))
+            theirs_html, theirs_images = normalize(reader_app.decompress_chapter(theirs['content']))
+            if ours_images != theirs_images:
+                mismatches.append(f'{href}: image attributes differ')
+            elif ours_html != theirs_html:
+                mismatches.append(f'{href}: markup differs')
+        print(f'{name:<12} {elapsed:>8.3f} {len(chapters) / elapsed:>11.1f} {total_bytes / 1e6 / elapsed:>7.2f} '
+              f'{results["html.parser"][0] / elapsed:>7.1f}x  {"yes" if not mismatches else f"no ({len(mismatches)})"}')
+        for mismatch in mismatches[:5]:
+            print(f'    {mismatch}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Benchmark ingestion and the reading endpoints on synthetic EPUBs.
+
+Usage: python benchmark.py [--output results.json] [--chapters N] [--words N]
+                           [--images N] [--image-width PX] [--image-height PX]
+                           [--books N] [--requests N] [--parser NAME] [--cold]
+
+Generates a corpus with epub_generator, times EPUBReader.parse_epub and
+stream_epub on it, then measures latency percentiles of /chapter, /pages,
+/search, /image, /toc and /progress through the Flask test client. Everything
+runs against a throwaway database. Results are written as JSON so runs can be
+compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from epub_generator import VOCABULARY, generate_epub
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+    return {
+        'count': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': pick(50),
+        'p90_ms': pick(90),
+        'p99_ms': pick(99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def time_ingest(ingest, paths):
+    runs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        result = ingest(path)
+        elapsed = time.perf_counter() - start
+        runs.append({'seconds': elapsed, 'bytes': size, 'chapters': result['chapter_count'],
+                     'peak_memory_kb': result['peak_memory_kb']})
+    seconds = sum(run['seconds'] for run in runs)
+    return {
+        'books': len(runs),
+        'seconds': seconds,
+        'books_per_second': len(runs) / seconds,
+        'mb_per_second': sum(run['bytes'] for run in runs) / 1e6 / seconds,
+        'chapters_per_second': sum(run['chapters'] for run in runs) / seconds,
+        'peak_memory_kb': max((run['peak_memory_kb'] or 0) for run in runs) or None,
+        'runs': runs,
+    }
+
+
+def time_requests(client, make_request, count, before=None):
+    samples = []
+    for n in range(count):
+        if before:
+            before()
+        start = time.perf_counter()
+        response = make_request(n)
+        response.get_data()
+        samples.append(time.perf_counter() - start)
+        if response.status_code not in (200, 206):
+            raise RuntimeError(f'{response.request.path} returned {response.status_code}')
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--books', type=int, default=3)
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--words', type=int, default=3000, help='words per chapter')
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--image-width', type=int, default=800)
+    parser.add_argument('--image-height', type=int, default=600)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--parser', help='HTML parser backend, defaults to the fastest installed')
+    parser.add_argument('--cold', action='store_true', help='clear the response cache before every request')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Importing app opens its database, keep it out of the working directory
+        os.environ['READER_DB'] = os.path.join(tmp, 'reader.db')
+        if args.parser:
+            os.environ['READER_HTML_PARSER'] = args.parser
+        import app as reader_app
+        reader = reader_app.reader
+
+        paths = [generate_epub(os.path.join(tmp, f'book{n}.epub'), args.chapters, args.words, args.images,
+                               args.image_width, args.image_height, title=f'Synthetic Book {n + 1}', seed=n)
+                 for n in range(args.books)]
+
+        ingest = {}
+        for name, parse in (('parse_epub', reader.parse_epub), ('stream_epub', reader.stream_epub)):
+            # Each path starts from an empty library, otherwise the second would
+            # find the image variants already stored and skip transcoding them
+            for (book_id,) in reader.db.fetchall("SELECT id FROM books"):
+                reader.delete_book(book_id)
+            ingest[name] = time_ingest(parse, paths)
+
+        book_id = reader.db.fetchone("SELECT id FROM books ORDER BY rowid DESC LIMIT 1")[0]
+        chapters = reader.db.fetchone("SELECT chapters FROM books WHERE id = ?", (book_id,))[0]
+        images = [row[0] for row in reader.db.fetchall(
+            "SELECT filename FROM book_images WHERE book_id = ? ORDER BY filename", (book_id,))]
+        rng = random.Random(0)
+        queries = [rng.choice(VOCABULARY) for _ in range(args.requests)]
+
+        client = reader_app.app.test_client()
+        before = reader_app.response_cache.clear if args.cold else None
+        endpoints = {
+            'chapter': lambda n: client.get(f'/chapter/{book_id}/{n % chapters}'),
+            'search': lambda n: client.get(f'/search/{book_id}/{queries[n]}'),
+            'page': lambda n: client.get(f'/pages/{book_id}/{n % chapters}/1'),
+            'toc': lambda n: client.get(f'/toc/{book_id}'),
+            'progress': lambda n: client.post('/progress', json={'book_id': book_id, 'chapter': n % chapters,
+                                                                 'page': n % 10 + 1}),
+        }
+        if images:
+            endpoints['image'] = lambda n: client.get(f'/image/{book_id}/{images[n % len(images)]}')
+        latency = {name: time_requests(client, make_request, args.requests, before)
+                   for name, make_request in endpoints.items()}
+
+        results = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'html_parser': reader.parser.name,
+            'config': {name: value for name, value in vars(args).items() if name != 'output'},
+            'corpus_bytes': sum(os.path.getsize(path) for path in paths),
+            'ingest': ingest,
+            'endpoints': latency,
+        }
+        # Buffered progress has to land before the temporary database goes away
+        reader.flush_progress()
+        reader.db.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
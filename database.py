@@ -0,0 +1,176 @@
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    # Low-cardinality name for a statement, such as "SELECT chapters"
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ''
+    table = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', sql, re.IGNORECASE)
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports execute and fetch times to Database.observer"""
+    statement = None
+
+    def execute(self, sql, params=()):
+        return self._timed(statement_label(sql), 'execute', super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(statement_label(sql), 'execute', super().executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        return self._timed(self.statement, 'fetch', super().fetchone)
+
+    def fetchall(self):
+        return self._timed(self.statement, 'fetch', super().fetchall)
+
+    def _timed(self, statement, phase, method, *args):
+        observer = self.connection.database.observer
+        if observer is None:
+            return method(*args)
+        self.statement = statement
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            observer(statement, phase, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    database = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        observer = self.database.observer
+        if observer is None:
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            observer('COMMIT', 'execute', time.perf_counter() - start)
+
+
+class Database:
+    """Per-thread pooled SQLite connections for reader.db"""
+
+    PRAGMAS = (
+        ('synchronous', 'NORMAL'),      # safe with WAL, avoids an fsync per commit
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -16 * 1024),     # negative means KiB, so 16MB per connection
+        ('temp_store', 'MEMORY'),
+    )
+
+    def __init__(self, path, timeout=30, cached_statements=256, functions=None):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        # {name: callable} of one-argument SQL functions registered on every
+        # connection, for use in views and triggers. A schema that uses them
+        # can only be fully read and written by connections that register
+        # them too
+        self.functions = functions or {}
+        self.local = threading.local()
+        # observer(statement, phase, seconds) is called for every query when set
+        self.observer = None
+
+        # WAL is persistent in the database file, so it only has to be set once.
+        # auto_vacuum only takes effect on a new database or on the next VACUUM.
+        conn = self.connect()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    def connect(self):
+        # Connections are reused per thread; a forked ingest worker must not
+        # share its parent's connection, so they are also keyed by process
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               cached_statements=self.cached_statements,
+                               check_same_thread=False, factory=TimedConnection)
+        conn.database = self
+        for name, function in self.functions.items():
+            conn.create_function(name, 1, function, deterministic=True)
+        for name, value in self.PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
+
+    def file_size(self):
+        # The database file plus its write-ahead log
+        return sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal')
+                   if os.path.exists(self.path + suffix))
+
+    def fetchone(self, sql, params=()):
+        return self.connect().execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        return self.connect().execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.transaction() as c:
+            c.execute(sql, params)
+            return c.rowcount
+
+    def iter_blob(self, table, column, rowid, start=0, length=None, chunk_size=64 * 1024):
+        # Reads a BLOB incrementally instead of materializing the whole value
+        conn = self.connect()
+        if not hasattr(conn, 'blobopen'):
+            # Python before 3.11 has no incremental BLOB I/O; substr() on a
+            # BLOB reads a byte range
+            if length is None:
+                length = conn.execute(f"SELECT length({column}) FROM {table} WHERE rowid = ?",
+                                      (rowid,)).fetchone()[0] - start
+            for offset in range(start, start + length, chunk_size):
+                yield conn.execute(f"SELECT substr({column}, ?, ?) FROM {table} WHERE rowid = ?",
+                                   (offset + 1, min(chunk_size, start + length - offset), rowid)).fetchone()[0]
+            return
+        with conn.blobopen(table, column, rowid, readonly=True) as blob:
+            blob.seek(start)
+            remaining = len(blob) - start if length is None else length
+            while remaining > 0:
+                chunk = blob.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent writers
+        # wait on busy_timeout instead of failing on a lock upgrade
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        c = conn.cursor()
+        try:
+            yield c
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
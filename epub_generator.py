@@ -0,0 +1,101 @@
+"""Generate synthetic EPUBs for benchmarking.
+
+Usage: python epub_generator.py OUT_DIR [--books N] [--chapters N] [--words N]
+                                [--images N] [--image-width PX] [--image-height PX]
+
+Books are reproducible for a given seed. Images are PNGs of random pixels, so
+they do not compress and their size is roughly width * height * 3 bytes.
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import zlib
+
+from ebooklib import epub
+
+VOCABULARY = ('the', 'dragon', 'river', 'lantern', 'winter', 'castle', 'whisper', 'forest',
+              'silver', 'morning', 'stone', 'harbor', 'ember', 'journey', 'quiet', 'shadow',
+              'garden', 'letter', 'captain', 'mountain', 'café', 'naïve', 'and', 'of', 'to')
+WORDS_PER_PARAGRAPH = 120
+
+
+def make_png(width, height, rng):
+    # Random RGB rows, each prefixed with filter type 0
+    raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 1))
+            + chunk(b'IEND', b''))
+
+
+def make_chapter_html(number, words, image_names, rng):
+    parts = [f'<h1>Chapter {number}</h1>', f'<a id="chapter-{number}"/>']
+    for name in image_names:
+        parts.append(f'<p class="figure"><img src="../images/{name}" alt="{name}"/></p>')
+    for start in range(0, words, WORDS_PER_PARAGRAPH):
+        text = ' '.join(rng.choice(VOCABULARY) for _ in range(min(WORDS_PER_PARAGRAPH, words - start)))
+        head, _, tail = text.partition(' ')
+        parts.append(f'<p><em>{head}</em> {tail}</p>')
+    return f'<html><head><title>Chapter {number}</title></head><body>{"".join(parts)}</body></html>'
+
+
+def generate_epub(path, chapters=20, words=3000, images=5, image_width=800, image_height=600,
+                  title='Synthetic Book', seed=0):
+    """Write an EPUB with the given shape to path and return path"""
+    rng = random.Random(seed)
+    book = epub.EpubBook()
+    book.set_identifier(f'synthetic-{seed}')
+    book.set_title(title)
+    book.set_language('en')
+    book.add_author('Benchmark')
+
+    image_names = [f'image{n:03d}.png' for n in range(images)]
+    for n, name in enumerate(image_names):
+        book.add_item(epub.EpubItem(uid=f'image{n}', file_name=f'images/{name}', media_type='image/png',
+                                    content=make_png(image_width, image_height, rng)))
+
+    items = []
+    for n in range(chapters):
+        item = epub.EpubHtml(title=f'Chapter {n + 1}', file_name=f'text/chapter{n + 1:03d}.xhtml', lang='en')
+        # Spread the images across the chapters
+        item.content = make_chapter_html(n + 1, words, image_names[n::chapters], rng)
+        book.add_item(item)
+        items.append(item)
+
+    book.toc = items
+    book.spine = items
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('out_dir')
+    parser.add_argument('--books', type=int, default=1)
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--words', type=int, default=3000, help='words per chapter')
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--image-width', type=int, default=800)
+    parser.add_argument('--image-height', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for n in range(args.books):
+        path = generate_epub(os.path.join(args.out_dir, f'synthetic_{n:03d}.epub'), args.chapters, args.words,
+                             args.images, args.image_width, args.image_height,
+                             title=f'Synthetic Book {n + 1}', seed=args.seed + n)
+        print(f'{path} {os.path.getsize(path) / 1e6:.1f} MB')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+# Production server settings, used as: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('READER_BIND', '0.0.0.0:8000')
+# Processes for CPU-bound work (JSON, gzip, HTML rewriting) and threads per
+# process for requests that mostly wait on SQLite or the network
+workers = int(os.environ.get('READER_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('READER_THREADS', 4))
+worker_class = 'gthread'
+# Import the app once in the master so migrations and warm-up run a single
+# time and the workers share the loaded modules and warm cache copy-on-write
+preload_app = True
+timeout = 120
+keepalive = 5
+graceful_timeout = 30
+
+# Each worker has its own ingest pool; split the cores between them instead of
+# starting a pool per core in every worker
+os.environ.setdefault('READER_INGEST_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+
+# Buffered progress lives in one process, so with several workers a read could
+# miss a newer position held by another, or an older flush overwrite it. Write
+# through instead
+if workers > 1:
+    os.environ['READER_PROGRESS_FLUSH_SECONDS'] = '0'
+
+
+def post_fork(server, worker):
+    # The master's warm-up requests would otherwise be counted again by every
+    # worker; metrics are labelled by pid from here on
+    from app import metrics
+    metrics.reset()
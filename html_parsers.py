@@ -0,0 +1,166 @@
+import re
+from bs4 import BeautifulSoup, UnicodeDammit
+
+try:
+    import lxml.html
+except ImportError:  # falls back to html.parser
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # falls back to lxml or html.parser
+    LexborHTMLParser = None
+
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+# XHTML self-closing tags like <a id="x"/>; HTML parsers would leave them open.
+# Unquoted names and values stop at '<' so an unterminated tag fails fast
+# instead of every attempt scanning to the end of the document
+SELF_CLOSING_TAG = re.compile(
+    r'<([a-zA-Z][\w:.-]*)((?:\s+[^\s=/<>]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'<>]+))?)*)\s*/>')
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+                 'meta', 'param', 'source', 'track', 'wbr'}
+# bs4's get_text() leaves out the contents of these
+NON_TEXT_ELEMENTS = ('script', 'style', 'template')
+
+
+def decode_markup(content):
+    # EPUB content documents must be UTF-8 or UTF-16
+    if isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            content = UnicodeDammit(content, is_html=True).unicode_markup
+    return XML_DECLARATION.sub('', content, count=1)
+
+
+def expand_self_closing(markup):
+    def expand(match):
+        name = match.group(1)
+        if name.lower() in VOID_ELEMENTS:
+            return match.group(0)
+        return f'<{name}{match.group(2)}></{name}>'
+    return SELF_CLOSING_TAG.sub(expand, markup)
+
+
+class SoupParser:
+    """BeautifulSoup with the pure-Python html.parser, always available"""
+    name = 'html.parser'
+
+    def parse(self, content):
+        return BeautifulSoup(content, 'html.parser')
+
+    def images(self, doc):
+        return doc.find_all('img')
+
+    def get_attr(self, element, name):
+        return element.get(name)
+
+    def set_attr(self, element, name, value):
+        element[name] = value
+
+    def clear_head(self, doc):
+        if doc.head:
+            doc.head.clear()
+
+    def text(self, doc):
+        return doc.get_text()
+
+    def find_text(self, doc, tag):
+        element = doc.find(tag)
+        return element.get_text() if element else None
+
+    def serialize(self, doc):
+        return str(doc)
+
+
+class LxmlParser(SoupParser):
+    """libxml2's HTML parser through lxml.html"""
+    name = 'lxml'
+    TEXT = './/text()[not(ancestor::script or ancestor::style or ancestor::template)]'
+
+    def parse(self, content):
+        markup = decode_markup(content)
+        if not markup.strip():
+            markup = '<html></html>'
+        return lxml.html.document_fromstring(markup)
+
+    def images(self, doc):
+        return doc.iter('img')
+
+    def set_attr(self, element, name, value):
+        element.set(name, value)
+
+    def clear_head(self, doc):
+        head = doc.find('head')
+        if head is not None:
+            for child in list(head):
+                head.remove(child)
+            head.text = None
+
+    def text(self, doc):
+        return ''.join(doc.xpath(self.TEXT))
+
+    def find_text(self, doc, tag):
+        element = doc.find(f'.//{tag}')
+        return ''.join(element.xpath(self.TEXT)) if element is not None else None
+
+    def serialize(self, doc):
+        tree = doc.getroottree()
+        return lxml.html.tostring(tree, encoding='unicode', doctype=tree.docinfo.doctype)
+
+
+class SelectolaxParser(SoupParser):
+    """lexbor's HTML5 parser through selectolax"""
+    name = 'selectolax'
+
+    def parse(self, content):
+        return LexborHTMLParser(expand_self_closing(decode_markup(content)))
+
+    def images(self, doc):
+        return doc.css('img')
+
+    def get_attr(self, element, name):
+        return element.attributes.get(name)
+
+    def set_attr(self, element, name, value):
+        element.attrs[name] = value
+
+    def clear_head(self, doc):
+        if doc.head is not None:
+            for child in list(doc.head.iter(include_text=True)):
+                child.decompose()
+
+    def text(self, doc):
+        return self._text(doc.root) if doc.root is not None else ''
+
+    def find_text(self, doc, tag):
+        element = doc.css_first(tag)
+        return self._text(element) if element is not None else None
+
+    def serialize(self, doc):
+        return doc.html
+
+    def _text(self, node):
+        return ''.join(child.text_content for child in node.traverse(include_text=True)
+                       if child.tag == '-text' and child.parent.tag not in NON_TEXT_ELEMENTS)
+
+
+# In order of preference
+PARSERS = {
+    'selectolax': (SelectolaxParser, lambda: LexborHTMLParser is not None),
+    'lxml': (LxmlParser, lambda: lxml is not None),
+    'html.parser': (SoupParser, lambda: True),
+}
+
+
+def available_parsers():
+    return [name for name, (parser, available) in PARSERS.items() if available()]
+
+
+def get_parser(name=None):
+    """Return the named parser backend, or the fastest one installed"""
+    if name is None:
+        name = available_parsers()[0]
+    if name not in PARSERS or not PARSERS[name][1]():
+        raise ValueError(f'HTML parser {name!r} is not available; installed: {", ".join(available_parsers())}')
+    return PARSERS[name][0]()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Import a directory of EPUBs into the library from the command line.
+
+Usage: python import_library.py DIR [DIR ...] [--workers N] [--db PATH]
+                                [--parser NAME] [--in-memory]
+
+Files are hashed in parallel first, and any whose content is already in the
+library is skipped. The rest are parsed across worker processes, each book in
+its own transaction, so an interrupted import is resumed by running the same
+command again. Unlike /upload there is no size limit or filename restriction.
+"""
+import argparse
+import hashlib
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def find_epubs(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith('.epub'):
+                    yield os.path.join(root, name)
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return path, sha.hexdigest(), os.path.getsize(path)
+
+
+def import_book(path, content_hash, size, streaming):
+    # Runs in a pool worker, which shares the app's reader and database
+    from app import reader
+    parse = reader.stream_epub if streaming else reader.parse_epub
+    return parse(path, source=(content_hash, os.path.basename(path), size))
+
+
+def format_rate(count, size, seconds):
+    seconds = max(seconds, 1e-9)
+    return f'{count / seconds:.2f} books/s, {size / 1e6 / seconds:.2f} MB/s'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+', metavar='DIR', help='directories to scan, or EPUB files')
+    parser.add_argument('--workers', type=int, help='parallel parsing processes, defaults to one per core')
+    parser.add_argument('--db', help='database path, defaults to READER_DB or reader.db')
+    parser.add_argument('--parser', help='HTML parser backend, defaults to the fastest installed')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='load each EPUB whole with ebooklib instead of streaming it from the zip')
+    args = parser.parse_args()
+
+    # The app reads its configuration from the environment at import
+    if args.db:
+        os.environ['READER_DB'] = args.db
+    if args.parser:
+        os.environ['READER_HTML_PARSER'] = args.parser
+    import app as reader_app
+    reader = reader_app.reader
+    workers = args.workers or reader_app.app.config['INGEST_WORKERS']
+
+    paths = list(find_epubs(args.paths))
+    print(f'Found {len(paths)} EPUB files, hashing with {workers} workers')
+    start = time.perf_counter()
+    totals = {'imported': 0, 'bytes': 0, 'skipped': 0, 'failed': 0}
+    # Workers leave Ctrl-C to this process, which lets the books in progress finish
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=signal.signal,
+                               initargs=(signal.SIGINT, signal.SIG_IGN))
+    futures = {}
+
+    def report(future):
+        path, size = futures[future]
+        done = sum(totals[name] for name in ('imported', 'failed')) + 1
+        try:
+            book = future.result()
+        except Exception as e:
+            totals['failed'] += 1
+            print(f'[{done}/{len(futures)}] failed {path}: {e}', file=sys.stderr)
+            return
+        totals['imported'] += 1
+        totals['bytes'] += size
+        rate = format_rate(totals['imported'], totals['bytes'], time.perf_counter() - import_start)
+        print(f'[{done}/{len(futures)}] {book["title"]} ({book["chapter_count"]} chapters, '
+              f'{size / 1e6:.1f} MB) - {rate}')
+
+    try:
+        pending = []
+        seen = set()
+        for path, content_hash, size in pool.map(hash_file, paths, chunksize=8):
+            # Duplicates within this run are skipped too
+            if content_hash in seen or reader.find_book_by_hash(content_hash):
+                totals['skipped'] += 1
+            else:
+                pending.append((path, content_hash, size))
+            seen.add(content_hash)
+        print(f'{totals["skipped"]} already imported, {len(pending)} to import')
+
+        import_start = time.perf_counter()
+        for path, content_hash, size in pending:
+            futures[pool.submit(import_book, path, content_hash, size, not args.in_memory)] = (path, size)
+        remaining = set(futures)
+        try:
+            for future in as_completed(futures):
+                remaining.discard(future)
+                report(future)
+        except KeyboardInterrupt:
+            running = [future for future in remaining if not future.cancel()]
+            print(f'\nInterrupted, finishing {len(running)} books in progress. '
+                  f'Run the same command again to import the rest.', file=sys.stderr)
+            for future in as_completed(running):
+                report(future)
+            return 130
+    except KeyboardInterrupt:
+        print('\nInterrupted', file=sys.stderr)
+        return 130
+    finally:
+        pool.shutdown(cancel_futures=True)
+        elapsed = time.perf_counter() - start
+        print(f'Imported {totals["imported"]} books ({totals["bytes"] / 1e6:.1f} MB) in {elapsed:.1f}s: '
+              f'{format_rate(totals["imported"], totals["bytes"], elapsed)}; '
+              f'{totals["skipped"]} skipped, {totals["failed"]} failed')
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
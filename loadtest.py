@@ -0,0 +1,102 @@
+"""Measure request throughput of a running reader server.
+
+Usage: python loadtest.py [--url http://localhost:8000] [--concurrency N]
+                          [--seconds N]
+
+Opens the most recently added book and replays a reading mix against it from
+N threads over keep-alive connections: page turns, a book open, a TOC fetch and
+the occasional search. Prints requests per second and latency percentiles per
+endpoint. Compare servers on the same database, e.g. run.py against
+gunicorn -c gunicorn.conf.py wsgi:app.
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from benchmark import percentiles
+from epub_generator import VOCABULARY
+
+# Relative weight of each request in the mix
+MIX = (('page', 12), ('bundle', 1), ('toc', 2), ('search', 1))
+
+
+def get(conn, path):
+    conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+    response = conn.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise RuntimeError(f'{path} returned {response.status}')
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=20)
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    conn = http.client.HTTPConnection(url.hostname, url.port)
+    books = json.loads(get(conn, '/books?sort=recent&limit=1'))['items']
+    if not books:
+        print('The library is empty', file=sys.stderr)
+        return 1
+    book_id = books[0]['id']
+    page_map = json.loads(get(conn, f'/page_map/{book_id}'))['chapters']
+    pages = [(chapter['chapter'], page) for chapter in page_map for page in range(1, chapter['total_pages'] + 1)]
+    names = [name for name, weight in MIX for _ in range(weight)]
+    paths = {
+        'page': lambda rng: '/pages/{}/{}/{}'.format(book_id, *rng.choice(pages)),
+        'bundle': lambda rng: f'/book_bundle/{book_id}?ahead=1',
+        'toc': lambda rng: f'/toc/{book_id}',
+        'search': lambda rng: f'/search/{book_id}/{quote(rng.choice(VOCABULARY))}?limit=20',
+    }
+
+    samples = {name: [] for name, weight in MIX}
+    errors = []
+    deadline = time.perf_counter() + args.seconds
+
+    def client(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection(url.hostname, url.port)
+        while time.perf_counter() < deadline:
+            name = rng.choice(names)
+            start = time.perf_counter()
+            try:
+                get(conn, paths[name](rng))
+            except Exception as e:
+                errors.append(e)
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port)
+                continue
+            samples[name].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(values) for values in samples.values())
+    print(json.dumps({
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'seconds': elapsed,
+        'requests': total,
+        'requests_per_second': total / elapsed,
+        'errors': len(errors),
+        'endpoints': {name: percentiles(values) for name, values in samples.items() if values},
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Purge orphaned rows and compact the reader database.
+
+Usage: python maintenance.py [--db PATH] [--full] [--rebuild-stats] [--json]
+
+Removes rows left behind by deleted books and interrupted ingests, image blobs
+no book refers to and old ingest jobs, then runs an incremental VACUUM and
+ANALYZE. Safe to run while the app is serving. Without --full, the same
+operation is available as POST /admin/maintenance when READER_ADMIN_TOKEN is
+set, authenticated with "Authorization: Bearer <token>".
+"""
+import argparse
+import json
+import os
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='database path, defaults to READER_DB or reader.db')
+    parser.add_argument('--full', action='store_true',
+                        help='run a full VACUUM, which blocks writes; needed once on databases '
+                             'created before incremental vacuum was enabled')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='recompute the text statistics of every book from the stored chapters')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['READER_DB'] = args.db
+    from app import reader
+    if args.rebuild_stats:
+        reader.rebuild_book_stats()
+    report = reader.run_maintenance(args.full)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    for table, rows in report['purged'].items():
+        if rows:
+            print(f'Purged {rows} rows from {table}')
+    if report['vacuum'] == 'skipped':
+        print(f'{report["free_bytes"] / 1e6:.1f} MB free inside the file; incremental vacuum is not enabled '
+              f'on this database, run with --full once to enable it')
+    print(f'{report["bytes_before"] / 1e6:.1f} MB -> {report["bytes_after"] / 1e6:.1f} MB, '
+          f'reclaimed {report["reclaimed_bytes"] / 1e6:.1f} MB in {report["seconds"]:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
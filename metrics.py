@@ -0,0 +1,107 @@
+import bisect
+import os
+import threading
+import time
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in Prometheus text format.
+
+    Every series carries a pid label: each server worker process counts on its
+    own, and a scrape reaches whichever worker accepts it, so the series of
+    different workers must not be mistaken for one another. Sum over pid to
+    get the totals.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, description):
+        self.families[name] = ('counter', description, None, {})
+
+    def gauge(self, name, description):
+        self.families[name] = ('gauge', description, None, {})
+
+    def histogram(self, name, description, buckets):
+        self.families[name] = ('histogram', description, buckets, {})
+
+    def inc(self, name, value=1, **labels):
+        series = self.families[name][3]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.families[name][3][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        kind, description, buckets, series = self.families[name]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            # Per-bucket counts with +Inf last, then sum and count
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * (len(buckets) + 3)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def reset(self):
+        # Drop the values a forked process inherited from its parent
+        with self.lock:
+            for kind, description, buckets, series in self.families.values():
+                series.clear()
+
+    def render(self):
+        lines = []
+        worker = (('pid', os.getpid()),)
+        with self.lock:
+            for name, (kind, description, buckets, series) in self.families.items():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(series.items()):
+                    key = worker + key
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_labels(key)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), value):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_labels(key + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(key)} {value[-2]}')
+                    lines.append(f'{name}_count{format_labels(key)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(key):
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
+
+
+class StageTimer:
+    """Wraps a progress(stage, done, total) callback and times each stage.
+
+    The time since the previous call is charged to the stage being reported,
+    not counting the wrapped callback itself.
+    """
+
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.seconds = {}
+        self.last = time.perf_counter()
+
+    def __call__(self, stage, done, total):
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0) + now - self.last
+        if self.progress is not None:
+            self.progress(stage, done, total)
+        self.last = time.perf_counter()
@@ -0,0 +1,145 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+
+from html_parsers import VOID_ELEMENTS, NON_TEXT_ELEMENTS
+
+WORD = re.compile(r'\w+')
+# A page may end after any of these closes
+BLOCK_ELEMENTS = {'address', 'article', 'aside', 'blockquote', 'dd', 'details', 'div', 'dl', 'dt',
+                  'figcaption', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+                  'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'}
+# Elements that make a page worth showing even without any words
+MEDIA_ELEMENTS = {'img', 'svg', 'image', 'video', 'audio', 'object', 'iframe', 'hr', 'table'}
+
+
+class Paginator(HTMLParser):
+    """Splits a chapter's body into well-formed page fragments.
+
+    A page ends at the first block element close after words_per_page words.
+    Elements still open at a break are closed there and reopened, with the
+    same start tag, at the top of the next page. A single block longer than
+    twice words_per_page is split between words.
+
+    Words are counted like the chapter's word_count, including text outside
+    the body, so start_word lines up with offsets into the indexed text.
+    """
+
+    def __init__(self, words_per_page):
+        super().__init__(convert_charrefs=True)
+        self.words_per_page = words_per_page
+        self.pages = []
+        self.stack = []
+        self.in_body = True
+        self.raw_depth = 0
+        self.words = 0
+        self.start_page()
+
+    def feed_document(self, html):
+        # Fragments without a body element are paginated whole
+        self.in_body = re.search(r'<body[\s>]', html, re.IGNORECASE) is None
+        self.feed(html)
+        self.close()
+        if self.has_content or not self.pages:
+            self.end_page()
+        return self.pages
+
+    def start_page(self):
+        # Reopen the elements the previous page closed
+        self.parts = [start_tag for tag, start_tag in self.stack]
+        self.anchors = []
+        self.page_start = self.words
+        self.page_words = 0
+        self.has_content = False
+
+    def end_page(self):
+        closing = ''.join(f'</{tag}>' for tag, start_tag in reversed(self.stack))
+        self.pages.append({
+            'content': ''.join(self.parts) + closing,
+            'start_word': self.page_start,
+            'word_count': self.page_words,
+            'anchors': self.anchors,
+        })
+        self.start_page()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'body':
+            self.in_body = True
+            # Words before the body, such as the title, offset the first page
+            if not self.parts:
+                self.page_start = self.words
+            return
+        if tag in NON_TEXT_ELEMENTS and tag not in VOID_ELEMENTS:
+            self.raw_depth += 1
+        if not self.in_body:
+            return
+        start_tag = self.get_starttag_text()
+        self.parts.append(start_tag)
+        self.anchors.extend(value for name, value in attrs if name in ('id', 'name') and value)
+        if tag in MEDIA_ELEMENTS:
+            self.has_content = True
+        if tag not in VOID_ELEMENTS:
+            self.stack.append((tag, start_tag))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.in_body:
+            return
+        self.parts.append(self.get_starttag_text())
+        self.anchors.extend(value for name, value in attrs if name in ('id', 'name') and value)
+        if tag in MEDIA_ELEMENTS:
+            self.has_content = True
+
+    def handle_endtag(self, tag):
+        if tag in NON_TEXT_ELEMENTS:
+            self.raw_depth = max(0, self.raw_depth - 1)
+        if tag == 'body':
+            self.in_body = False
+            return
+        if not self.in_body or not any(open_tag == tag for open_tag, start_tag in self.stack):
+            return
+        # Closing an outer element implicitly closes anything left open inside it
+        while True:
+            open_tag, start_tag = self.stack.pop()
+            self.parts.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+        if tag in BLOCK_ELEMENTS and self.page_words >= self.words_per_page:
+            self.end_page()
+
+    def handle_data(self, data):
+        if self.raw_depth:
+            if self.in_body:
+                self.parts.append(data)
+            return
+        words = list(WORD.finditer(data))
+        if not self.in_body:
+            self.words += len(words)
+            return
+        limit = 2 * self.words_per_page
+        start = 0
+        while self.page_words + len(words) > limit:
+            # Split an oversized block after the word that fills the page
+            room = limit - self.page_words
+            cut = words[room - 1].end() if room > 0 else start
+            self.add_text(data[start:cut], room)
+            self.end_page()
+            words = words[room:]
+            start = cut
+        self.add_text(data[start:], len(words))
+
+    def add_text(self, text, words):
+        self.parts.append(escape(text, quote=False))
+        self.words += words
+        self.page_words += words
+        if text.strip():
+            self.has_content = True
+
+    def handle_comment(self, data):
+        if self.in_body:
+            self.parts.append(f'<!--{data}-->')
+
+
+def paginate(html, words_per_page):
+    """Split chapter HTML into a list of page dicts with content, start_word,
+    word_count and anchors (element ids on the page)"""
+    return Paginator(words_per_page).feed_document(html)
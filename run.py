@@ -18,13 +18,14 @@ def install_requirements():
 
 def run_app():
     """Run the Flask application"""
-    from app import app
+    from app import app, reader
+    reader.fail_unfinished_jobs()
     print("🚀 Starting Python EPUB Reader...")
     print("📖 Open http://localhost:5000 in your browser")
     app.run(debug=True, host='0.0.0.0', port=5000)
 
 if __name__ == '__main__':
-    if not os.path.exists('reader.db'):
+    if not os.path.exists(os.environ.get('READER_DB', 'reader.db')):
         print("📚 First time setup - installing dependencies...")
         install_requirements()
     
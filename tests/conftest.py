@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Importing app opens READER_DB, keep it out of the working directory
+os.environ.setdefault('READER_DB', os.path.join(tempfile.mkdtemp(), 'reader.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from app import BOOK_SORTS, BOOKMARK_SORTS, EPUBReader, encode_cursor, decode_cursor
+
+
+@pytest.fixture(scope='module')
+def reader(tmp_path_factory):
+    reader = EPUBReader(str(tmp_path_factory.mktemp('keyset') / 'reader.db'))
+    rng = random.Random(7)
+    # Few distinct values, in mixed case, so every sort has long runs of ties
+    titles = ['alpha', 'Alpha', 'beta', 'Beta', 'gamma', '100% pure', 'under_score']
+    authors = ['Ann', 'ann', 'Bob', 'Unknown']
+    with reader.db.transaction() as c:
+        c.executemany("INSERT INTO books VALUES (?, ?, ?, ?, ?)",
+                      [(f'book-{n:03d}', rng.choice(titles), rng.choice(authors), rng.randint(1, 9), 'v')
+                       for n in range(137)])
+        c.executemany("""INSERT INTO bookmarks (book_id, chapter, page, chapter_title, bookmark_title,
+                                                description, created_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      [(f'book-{rng.randrange(5):03d}', rng.randrange(4), rng.randint(1, 3), 'Chapter',
+                        rng.choice(['note', 'quote', 'Note']), rng.choice(['', 'pure 100%']),
+                        f'2024-01-0{rng.randint(1, 3)} 00:00:00')
+                       for n in range(211)])
+    return reader
+
+
+def collect(get_page, limit):
+    items, cursor = [], None
+    while True:
+        page, cursor = get_page(cursor=cursor, limit=limit)
+        assert len(page) <= limit
+        items.extend(page)
+        if cursor is None:
+            return items
+
+
+@pytest.mark.parametrize('sort', sorted(BOOK_SORTS))
+@pytest.mark.parametrize('query', [None, 'alpha', '100%', '_'])
+@pytest.mark.parametrize('limit', [1, 7, 50, 500])
+def test_books_are_listed_once_in_order(reader, sort, query, limit):
+    items = collect(lambda **kwargs: reader.get_books(sort, query, **kwargs), limit)
+    everything, _ = reader.get_books(sort, query, limit=500)
+    assert [book['id'] for book in items] == [book['id'] for book in everything]
+    assert len({book['id'] for book in items}) == len(items)
+    if query == '_':
+        # LIKE wildcards in the query are matched literally
+        assert {book['title'] for book in items} == {'under_score'}
+    if sort == 'title':
+        keys = [book['title'].lower() for book in items]
+        assert keys == sorted(keys)
+
+
+@pytest.mark.parametrize('sort', sorted(BOOKMARK_SORTS))
+@pytest.mark.parametrize('book_id', [None, 'book-002'])
+@pytest.mark.parametrize('limit', [1, 10, 500])
+def test_bookmarks_are_listed_once_in_order(reader, sort, book_id, limit):
+    items = collect(lambda **kwargs: reader.get_bookmarks(book_id, sort, **kwargs), limit)
+    expected = reader.db.fetchall("SELECT id FROM bookmarks" + (" WHERE book_id = ?" if book_id else ""),
+                                  (book_id,) if book_id else ())
+    assert sorted(item['id'] for item in items) == sorted(row[0] for row in expected)
+    keys = ([(item['created_at'], item['id']) for item in items] if sort == 'created'
+            else [(item['chapter'], item['page'], item['id']) for item in items])
+    assert keys == sorted(keys, reverse=sort == 'created')
+
+
+def test_every_row_appears_once_while_rows_are_added(reader):
+    # Rows inserted behind the cursor do not shift the pages still to come
+    page, cursor = reader.get_books('recent', limit=20)
+    seen = [book['id'] for book in page]
+    reader.db.execute("INSERT INTO books VALUES ('book-new', 'zeta', 'Zed', 1, 'v')")
+    try:
+        while cursor:
+            page, cursor = reader.get_books('recent', cursor=cursor, limit=20)
+            seen.extend(book['id'] for book in page)
+    finally:
+        reader.db.execute("DELETE FROM books WHERE id = 'book-new'")
+    assert 'book-new' not in seen
+    assert len(seen) == len(set(seen)) == 137
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!', encode_cursor('x'), encode_cursor([1]), encode_cursor([{}, 1]),
+    encode_cursor([[1], 2]), encode_cursor([2 ** 64, 1]),
+])
+def test_invalid_cursors_are_rejected(reader, cursor):
+    with pytest.raises(ValueError):
+        reader.get_books('title', cursor=cursor)
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(['Alpha', 3]), 2) == ['Alpha', 3]
@@ -0,0 +1,124 @@
+from html.parser import HTMLParser
+
+import pytest
+
+from html_parsers import VOID_ELEMENTS
+from pagination import WORD, paginate
+
+
+class WellFormedChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.words = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        assert self.stack and self.stack[-1] == tag, f'</{tag}> does not close {self.stack}'
+        self.stack.pop()
+
+    def handle_data(self, data):
+        self.words += len(WORD.findall(data))
+
+
+class TextWords(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.words = 0
+
+    def handle_data(self, data):
+        self.words += len(WORD.findall(data))
+
+
+def count_words(html):
+    counter = TextWords()
+    counter.feed(html)
+    counter.close()
+    return counter.words
+
+
+def check_page(content):
+    checker = WellFormedChecker()
+    checker.feed(content)
+    checker.close()
+    assert checker.stack == [], f'unclosed {checker.stack}'
+    return checker.words
+
+
+def paragraphs(count, words, start=0):
+    return ''.join(f'<p>{" ".join(f"w{start + n}_{i}" for i in range(words))}</p>' for n in range(count))
+
+
+CHAPTERS = {
+    'flat': f'<html><body>{paragraphs(40, 30)}</body></html>',
+    'nested': ('<html><body><section class="s"><div id="d1"><em>lead</em>'
+               f'{paragraphs(20, 40)}</div><blockquote>{paragraphs(10, 25, 20)}</blockquote>'
+               f'<ul>{"".join(f"<li>item {n} <b>bold {n}</b></li>" for n in range(60))}</ul></section></body></html>'),
+    'oversized': f'<html><body><p><span>{" ".join(f"x{i}" for i in range(1000))}</span></p></body></html>',
+    'head_text': (f'<html><head><title>Three title words</title></head><body>{paragraphs(12, 50)}'
+                  '<img src="a.png"/><p id="end">tail</p></body></html>'),
+    'fragment': f'<div>{paragraphs(15, 30)}</div>',
+    'unclosed': '<html><body><div><p>' + ' '.join(f'u{i}' for i in range(700)) + '<p>more words here</body></html>',
+}
+
+
+@pytest.mark.parametrize('name', sorted(CHAPTERS))
+def test_pages_are_well_formed(name):
+    for page in paginate(CHAPTERS[name], 100):
+        check_page(page['content'])
+
+
+@pytest.mark.parametrize('name', sorted(CHAPTERS))
+def test_word_offsets_are_contiguous(name):
+    pages = paginate(CHAPTERS[name], 100)
+    first = pages[0]['start_word']
+    for page, following in zip(pages, pages[1:]):
+        assert following['start_word'] == page['start_word'] + page['word_count']
+    # Reopened start tags carry no text, so each page's words are its own
+    assert [check_page(page['content']) for page in pages] == [page['word_count'] for page in pages]
+    assert first + sum(page['word_count'] for page in pages) == count_words(CHAPTERS[name])
+
+
+def test_words_outside_body_offset_the_first_page():
+    pages = paginate(CHAPTERS['head_text'], 100)
+    assert pages[0]['start_word'] == 3
+
+
+def test_pages_break_at_block_ends():
+    pages = paginate(CHAPTERS['flat'], 100)
+    # 30-word paragraphs: a page ends at the first paragraph close past 100 words
+    assert [page['word_count'] for page in pages] == [120] * 10
+    assert all(page['content'].startswith('<p>') and page['content'].endswith('</p>') for page in pages)
+
+
+def test_oversized_block_is_split_between_words():
+    pages = paginate(CHAPTERS['oversized'], 100)
+    assert len(pages) == 5
+    assert all(page['word_count'] <= 200 for page in pages)
+    assert all(page['content'].startswith('<p><span>') for page in pages)
+
+
+def test_open_elements_are_reopened_on_the_next_page():
+    pages = paginate(CHAPTERS['nested'], 100)
+    assert len(pages) > 3
+    assert pages[1]['content'].startswith('<section class="s"><div id="d1">')
+    assert pages[0]['anchors'] == ['d1']
+    assert 'd1' not in pages[1]['anchors']
+
+
+def test_anchors_and_media_are_kept():
+    pages = paginate(CHAPTERS['head_text'], 100)
+    assert pages[-1]['anchors'] == ['end']
+    assert any('<img src="a.png"/>' in page['content'] for page in pages)
+
+
+def test_empty_chapter_gives_one_page():
+    pages = paginate('<html><body></body></html>', 100)
+    assert len(pages) == 1
+    assert pages[0]['word_count'] == 0
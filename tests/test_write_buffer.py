@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+from write_buffer import WriteBehindBuffer
+
+
+class TransientError(Exception):
+    pass
+
+
+class Store:
+    """Stand-in for the database: a dict written in batches, failing on request"""
+
+    def __init__(self):
+        self.rows = {}
+        self.batches = []
+        self.bad = set()
+        self.down = False
+
+    def write(self, values):
+        if self.down:
+            raise TransientError('database is locked')
+        if any(key in self.bad for key, value in values):
+            raise OverflowError('value out of range')
+        self.batches.append(list(values))
+        self.rows.update(values)
+
+
+@pytest.fixture
+def store():
+    return Store()
+
+
+@pytest.fixture
+def buffer(store):
+    # A long interval keeps the background thread from flushing during a test
+    buffer = WriteBehindBuffer(store.write, 3600, transient=(TransientError,))
+    yield buffer
+    store.down = False
+    store.bad.clear()
+    buffer.stop()
+
+
+def test_keeps_latest_value_per_key(buffer, store):
+    for n in range(5):
+        buffer.put('a', ('a', n))
+    buffer.put('b', ('b', 1))
+    assert buffer.get('a') == ('a', 4)
+    assert buffer.flush() == 2
+    assert store.batches == [[('a', 4), ('b', 1)]]
+    assert buffer.get('a') is None
+
+
+def test_last_key_follows_latest_update(buffer):
+    buffer.put('a', ('a', 1))
+    buffer.put('b', ('b', 1))
+    buffer.put('a', ('a', 2))
+    assert buffer.last_key() == 'a'
+
+
+def test_discard_drops_pending_value(buffer, store):
+    buffer.put('a', ('a', 1))
+    buffer.discard('a')
+    assert buffer.flush() == 0
+    assert store.rows == {}
+
+
+def test_failed_value_is_dropped_and_the_rest_written(buffer, store):
+    store.bad.add('bad')
+    buffer.put('a', ('a', 1))
+    buffer.put('bad', ('bad', 1))
+    buffer.put('b', ('b', 1))
+    buffer.flush()
+    assert store.rows == {'a': 1, 'b': 1}
+    assert buffer.get('bad') is None
+    # Later flushes are no longer blocked by it
+    buffer.put('c', ('c', 1))
+    buffer.flush()
+    assert store.rows == {'a': 1, 'b': 1, 'c': 1}
+
+
+def test_transient_failure_keeps_values_pending(buffer, store):
+    buffer.put('a', ('a', 1))
+    store.down = True
+    with pytest.raises(TransientError):
+        buffer.flush()
+    assert buffer.get('a') == ('a', 1)
+    store.down = False
+    buffer.flush()
+    assert store.rows == {'a': 1}
+    assert buffer.get('a') is None
+
+
+def test_update_during_flush_stays_pending(store):
+    writing = threading.Event()
+    release = threading.Event()
+
+    def slow_write(values):
+        writing.set()
+        release.wait(5)
+        store.write(values)
+
+    buffer = WriteBehindBuffer(slow_write, 3600)
+    buffer.put('a', ('a', 1))
+    flusher = threading.Thread(target=buffer.flush)
+    flusher.start()
+    writing.wait(5)
+    buffer.put('a', ('a', 2))
+    release.set()
+    flusher.join(5)
+    assert store.rows == {'a': 1}
+    assert buffer.get('a') == ('a', 2)
+    buffer.stop()
+    assert store.rows == {'a': 2}
+
+
+def test_background_thread_flushes(store):
+    buffer = WriteBehindBuffer(store.write, 0.01)
+    buffer.put('a', ('a', 1))
+    for _ in range(500):
+        if store.rows:
+            break
+        threading.Event().wait(0.01)
+    buffer.stop()
+    assert store.rows == {'a': 1}
@@ -0,0 +1,90 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Holds the latest value per key in memory and writes them in batches.
+
+    write(values) is called with the pending values, oldest update first,
+    every interval seconds from a background thread and on flush(). A value
+    stays visible through get() until it has been written, so readers never
+    see an older value from the database in between. Each process has its own
+    buffer.
+
+    If a batch fails, its values are written one at a time and those that
+    still fail are dropped, unless the error is one of the transient
+    exception types, which leave everything pending for the next flush.
+    """
+
+    def __init__(self, write, interval, transient=()):
+        self.write = write
+        self.interval = interval
+        self.transient = transient
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        # Serializes flushes so a discard cannot race a write in progress
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def put(self, key, value):
+        with self.lock:
+            # Re-insert so iteration order follows the latest update
+            self.pending.pop(key, None)
+            self.pending[key] = value
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self.thread.start()
+
+    def get(self, key):
+        with self.lock:
+            return self.pending.get(key)
+
+    def last_key(self):
+        with self.lock:
+            return next(reversed(self.pending), None)
+
+    def discard(self, key):
+        with self.flush_lock, self.lock:
+            self.pending.pop(key, None)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                items = list(self.pending.items())
+            if not items:
+                return 0
+            try:
+                self.write([value for key, value in items])
+            except self.transient:
+                raise
+            except Exception:
+                # Retry one by one so a single bad value cannot hold back the rest
+                logger.exception('Write-behind batch failed, retrying values one at a time')
+                for key, value in items:
+                    try:
+                        self.write([value])
+                    except self.transient:
+                        raise
+                    except Exception:
+                        logger.exception('Dropping value for %r that could not be written', key)
+            with self.lock:
+                for key, value in items:
+                    if self.pending.get(key) == value:
+                        del self.pending[key]
+            return len(items)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                # Values stay pending and are retried on the next interval
+                logger.exception('Write-behind flush failed')
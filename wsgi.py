@@ -0,0 +1,25 @@
+"""WSGI entry point for production serving.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py preloads this module in the gunicorn master: importing app
+applies any pending schema migrations, and warm_up() loads the parser modules
+and caches the recently read books, all once before the workers are forked.
+Ingest jobs left unfinished by the previous server are marked failed there too.
+"""
+import logging
+
+from app import app, reader, warm_up
+
+# Send the app's log, including slow request warnings, to gunicorn's error log
+gunicorn_logger = logging.getLogger('gunicorn.error')
+if gunicorn_logger.handlers:
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+
+interrupted = reader.fail_unfinished_jobs()
+if interrupted:
+    app.logger.warning('Marked %d interrupted ingest jobs failed', interrupted)
+warmed = warm_up()
+app.logger.info('Warmed up %d books (%d KB cached) in %.2fs',
+                warmed['books'], warmed['cache_bytes'] // 1024, warmed['seconds'])